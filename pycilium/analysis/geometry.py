@@ -41,13 +41,300 @@ def mean_radius_arc_distance(v1, v2, center_pt):
     return rmean * psi
 
 
+def as_pts_array(pts, ndim=3):
+    """(N, ndim) float array from an array or sequence of points,
+    with missing (None) points as NaN rows"""
+    if isinstance(pts, numpy.ndarray) and pts.dtype != object:
+        return pts.astype(float, copy=False).reshape(-1, ndim)
+    arr = numpy.full((len(pts), ndim), numpy.nan)
+    for i, pt in enumerate(pts):
+        if pt is not None:
+            arr[i] = pt
+    return arr
+
+
+def calculate_thetas(disps):
+    x, y, z = as_pts_array(disps).T
+    return numpy.arctan2(numpy.sqrt(x**2 + y**2), z)
+
+
+def calculate_phis(disps):
+    x, y = as_pts_array(disps).T[:2]
+    return numpy.arctan2(y, x)
+
+
+def calculate_dists(disps):
+    return numpy.linalg.norm(as_pts_array(disps), axis=1)
+
+
+def vecs_spherical_coords(disps):
+    disps = as_pts_array(disps)
+    r = calculate_dists(disps)
+    theta = calculate_thetas(disps)
+    phi = calculate_phis(disps)
+
+    return r, theta, phi
+
+
+def _normalized_rows(pts):
+    pts = as_pts_array(pts)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return pts / numpy.linalg.norm(pts, axis=1)[:, None]
+
+
+def cosine_similarities(a, b):
+    """row-wise cosine similarity of (N, 3) arrays, NaN for missing or
+    zero-length vectors"""
+    return numpy.einsum("ij,ij->i", _normalized_rows(a), _normalized_rows(b))
+
+
+def pairwise_cosine_similarity(a, b=None):
+    """(N, M) cosine similarity between rows of a and rows of b"""
+    a_norm = _normalized_rows(a)
+    b_norm = a_norm if b is None else _normalized_rows(b)
+    return a_norm @ b_norm.T
+
+
+def pairwise_angles(a, b=None):
+    """(N, M) angle in radians between rows of a and rows of b"""
+    return numpy.arccos(numpy.clip(pairwise_cosine_similarity(a, b), -1, 1))
+
+
+def _angle_block(a_norm, b_norm):
+    return numpy.arccos(numpy.clip(a_norm @ b_norm.T, -1, 1))
+
+
+def _arc_distance_block(a_norm, a_r, b_norm, b_r):
+    rmean = (a_r[:, None] + b_r[None, :]) / 2
+    return rmean * _angle_block(a_norm, b_norm)
+
+
+def _iter_pairwise_blocks(block_func, a_args, b_args, block_size,
+                          upper_only=False):
+    """yield (row_slice, col_slice, block) tiles of block_func over rows
+    of a_args against rows of b_args, skipping tiles entirely below the
+    diagonal if upper_only"""
+    n_a, n_b = len(a_args[0]), len(b_args[0])
+    for i in range(0, n_a, block_size):
+        rows = slice(i, min(i + block_size, n_a))
+        for j in range(0, n_b, block_size):
+            cols = slice(j, min(j + block_size, n_b))
+            if upper_only and cols.stop <= rows.start:
+                continue
+            yield rows, cols, block_func(
+                *(arg[rows] for arg in a_args),
+                *(arg[cols] for arg in b_args))
+
+
+def _radial_args(pts, centers):
+    """unit radial vectors and radii of points about per-point (N, 3) or
+    shared (3,) centers"""
+    rv = as_pts_array(pts) - as_pts_array(centers)
+    return _normalized_rows(rv), numpy.linalg.norm(rv, axis=1)
+
+
+def iter_pairwise_angle_blocks(a, b=None, block_size=4096,
+                               upper_only=False):
+    """yield (row_slice, col_slice, angles) tiles of pairwise_angles(a, b)
+    holding at most block_size**2 values at a time.  With upper_only,
+    tiles entirely below the diagonal are skipped."""
+    a_args = (_normalized_rows(a),)
+    b_args = a_args if b is None else (_normalized_rows(b),)
+    return _iter_pairwise_blocks(
+        _angle_block, a_args, b_args, block_size, upper_only)
+
+
+def iter_pairwise_arc_distance_blocks(pts, centers, pts_b=None,
+                                      centers_b=None, block_size=4096,
+                                      upper_only=False):
+    """yield (row_slice, col_slice, arc_distances) tiles of
+    pairwise_mean_radius_arc_distance, as iter_pairwise_angle_blocks.
+    centers_b defaults to centers only if that is a shared (3,) center."""
+    a_args = _radial_args(pts, centers)
+    if pts_b is not None and centers_b is None:
+        if len(as_pts_array(centers)) != 1:
+            raise ValueError(
+                "centers_b is required with pts_b and per-point centers")
+        centers_b = centers
+    b_args = a_args if pts_b is None else _radial_args(pts_b, centers_b)
+    return _iter_pairwise_blocks(
+        _arc_distance_block, a_args, b_args, block_size, upper_only)
+
+
+def _assemble_blocks(blocks, shape):
+    out = numpy.empty(shape)
+    for rows, cols, block in blocks:
+        out[rows, cols] = block
+    return out
+
+
+def _pairs_below(blocks, threshold, upper_only):
+    i_s, j_s, values = [], [], []
+    for rows, cols, block in blocks:
+        bi, bj = numpy.nonzero(block < threshold)
+        bi, bj = bi + rows.start, bj + cols.start
+        if upper_only:
+            upper = bi < bj
+            bi, bj = bi[upper], bj[upper]
+        i_s.append(bi)
+        j_s.append(bj)
+        values.append(block[bi - rows.start, bj - cols.start])
+    if not values:
+        return (numpy.empty(0, dtype=int), numpy.empty(0, dtype=int),
+                numpy.empty(0))
+    return (numpy.concatenate(i_s), numpy.concatenate(j_s),
+            numpy.concatenate(values))
+
+
+def pairwise_mean_radius_arc_distance(pts, centers, pts_b=None,
+                                      centers_b=None, block_size=4096):
+    """(N, M) mean_radius_arc_distance between points, each measured about
+    its own center.  centers may be per-point (N, 3) or shared (3,)."""
+    n_a = len(as_pts_array(pts))
+    n_b = n_a if pts_b is None else len(as_pts_array(pts_b))
+    return _assemble_blocks(iter_pairwise_arc_distance_blocks(
+        pts, centers, pts_b, centers_b, block_size), (n_a, n_b))
+
+
+def pairwise_arc_distances_below(pts, centers, threshold, pts_b=None,
+                                 centers_b=None, block_size=4096):
+    """sparse (i, j, arc_distance) for pairs closer than threshold,
+    computed in memory-bounded tiles.  Without pts_b only pairs with
+    i < j are returned."""
+    upper_only = pts_b is None
+    return _pairs_below(
+        iter_pairwise_arc_distance_blocks(
+            pts, centers, pts_b, centers_b, block_size, upper_only),
+        threshold, upper_only)
+
+
+def pairwise_angles_below(a, threshold, b=None, block_size=4096):
+    """sparse (i, j, angle) for vector pairs within threshold radians,
+    computed in memory-bounded tiles.  Without b only pairs with i < j
+    are returned."""
+    upper_only = b is None
+    return _pairs_below(
+        iter_pairwise_angle_blocks(a, b, block_size, upper_only),
+        threshold, upper_only)
+
+
+class AffinePointTransform:
+    """affine transform of points as a 4x4 homogeneous matrix, applied to
+    (N, 3) arrays in one matrix multiply"""
+    def __init__(self, matrix):
+        matrix = numpy.asarray(matrix, dtype=float)
+        if matrix.shape in ((3, 3), (3, 4)):
+            full = numpy.eye(4)
+            full[:3, :matrix.shape[1]] = matrix
+            matrix = full
+        if matrix.shape != (4, 4):
+            raise ValueError(
+                "affine matrix must be 3x3, 3x4 or 4x4, not {}".format(
+                    matrix.shape))
+        self.matrix = matrix
+
+    @classmethod
+    def identity(cls):
+        return cls(numpy.eye(4))
+
+    @classmethod
+    def scale(cls, scale):
+        """e.g. voxel resolution for pix -> nm"""
+        return cls(numpy.diag(numpy.broadcast_to(
+            numpy.asarray(scale, dtype=float), (3,))))
+
+    @classmethod
+    def translation(cls, offset):
+        matrix = numpy.eye(4)
+        matrix[:3, 3] = offset
+        return cls(matrix)
+
+    @classmethod
+    def mip(cls, from_resolution, to_resolution):
+        """scaling between mip levels as in cloudvolume's point_to_mip
+        (which additionally floors the result)"""
+        return cls.scale(
+            numpy.asarray(from_resolution, dtype=float) /
+            numpy.asarray(to_resolution, dtype=float))
+
+    def then(self, other):
+        """transform applying self followed by other"""
+        return self.__class__(other.matrix @ self.matrix)
+
+    def inverse(self):
+        return self.__class__(numpy.linalg.inv(self.matrix))
+
+    def __call__(self, pts):
+        pts = as_pts_array(pts)
+        return pts @ self.matrix[:3, :3].T + self.matrix[:3, 3]
+
+    def __repr__(self):
+        return "AffinePointTransform({})".format(self.matrix.tolist())
+
+
+class PointTransformPipeline:
+    """ordered point transforms applied to (N, 3) arrays.  Consecutive
+    AffinePointTransforms are fused into one matrix; any other callable
+    taking and returning (N, 3) arrays (e.g. numpy.floor) is a separate
+    stage."""
+    def __init__(self, transforms=()):
+        self.transforms = tuple(transforms)
+        self.stages = self._fuse(self.transforms)
+
+    @staticmethod
+    def _fuse(transforms):
+        stages = []
+        for transform in transforms:
+            if isinstance(transform, PointTransformPipeline):
+                transform_stages = transform.stages
+            else:
+                transform_stages = (transform,)
+            for stage in transform_stages:
+                if (isinstance(stage, AffinePointTransform) and stages and
+                        isinstance(stages[-1], AffinePointTransform)):
+                    stages[-1] = stages[-1].then(stage)
+                else:
+                    stages.append(stage)
+        return tuple(stages)
+
+    def then(self, *transforms):
+        return self.__class__(self.transforms + transforms)
+
+    def __call__(self, pts):
+        pts = as_pts_array(pts)
+        for stage in self.stages:
+            pts = stage(pts)
+        return pts
+
+    def __repr__(self):
+        return "PointTransformPipeline({})".format(list(self.stages))
+
+
 def _null_pt_preprocessor(pt):
     return pt
 
 
 class PointGeometryProcessor:
+    """point preprocessing: pt_preprocessor_func is applied per point,
+    followed by pt_transforms as a vectorized PointTransformPipeline"""
     pt_preprocessor_func = _null_pt_preprocessor
+    pt_transforms = ()
+
+    @classmethod
+    def pt_pipeline(cls):
+        return PointTransformPipeline(cls.pt_transforms)
 
     @classmethod
     def preprocess_pt(cls, pt):
-        return cls.pt_preprocessor_func(pt)
+        pt = cls.pt_preprocessor_func(pt)
+        if pt is None or not cls.pt_transforms:
+            return pt
+        return cls.pt_pipeline()([pt])[0]
+
+    @classmethod
+    def preprocess_pts(cls, pts):
+        """preprocess (N, 3) points in one pass"""
+        if cls.pt_preprocessor_func is not _null_pt_preprocessor:
+            pts = [None if pt is None else cls.pt_preprocessor_func(pt)
+                   for pt in pts]
+        return cls.pt_pipeline()(pts)
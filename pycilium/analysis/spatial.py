@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+spatial queries over cilium and soma points of a cilobj population
+"""
+import numpy
+import scipy.spatial
+import scipy.spatial.distance
+
+from pycilium.analysis.geometry import as_pts_array
+from pycilium.cilia import CiliaAnnotationTable
+
+
+def _table_kind_pts(table, kind):
+    """nm points and validity for a point kind of a CiliaAnnotationTable"""
+    pts = {
+        "tip": table.tip_nm,
+        "base": table.base_nm,
+        "exit": table.exit_nm,
+        "prox": table.prox_nm,
+        "soma_center": table.soma_center_pt_nm
+    }[kind]
+    return pts, ~numpy.isnan(pts).any(axis=1)
+
+
+class _KindIndex:
+    """kd-tree over one point kind plus a brute-force buffer of points
+    added since the tree was built"""
+    def __init__(self, rebuild_fraction, min_rebuild_size):
+        self.rebuild_fraction = rebuild_fraction
+        self.min_rebuild_size = min_rebuild_size
+        self.tree = None
+        self.tree_cell_idxs = numpy.empty(0, dtype=int)
+        self.pending_pts = numpy.empty((0, 3))
+        self.pending_cell_idxs = numpy.empty(0, dtype=int)
+
+    def __len__(self):
+        return len(self.tree_cell_idxs) + len(self.pending_cell_idxs)
+
+    def add(self, pts, cell_idxs):
+        self.pending_pts = numpy.concatenate([self.pending_pts, pts])
+        self.pending_cell_idxs = numpy.concatenate(
+            [self.pending_cell_idxs, cell_idxs])
+        if len(self.pending_cell_idxs) > max(
+                self.min_rebuild_size,
+                self.rebuild_fraction * len(self.tree_cell_idxs)):
+            self.rebuild()
+
+    def rebuild(self):
+        all_pts = self.pending_pts if self.tree is None else numpy.concatenate(
+            [self.tree.data, self.pending_pts])
+        self.tree_cell_idxs = numpy.concatenate(
+            [self.tree_cell_idxs, self.pending_cell_idxs])
+        self.tree = scipy.spatial.cKDTree(all_pts) if len(all_pts) else None
+        self.pending_pts = numpy.empty((0, 3))
+        self.pending_cell_idxs = numpy.empty(0, dtype=int)
+
+    def query_knn(self, pts, k):
+        dists = [numpy.full((len(pts), 0), numpy.inf)]
+        cell_idxs = [numpy.full((len(pts), 0), -1)]
+        if self.tree is not None:
+            tree_k = min(k, self.tree.n)
+            d, i = self.tree.query(pts, k=tree_k)
+            d, i = d.reshape(len(pts), tree_k), i.reshape(len(pts), tree_k)
+            dists.append(d)
+            cell_idxs.append(self.tree_cell_idxs[i])
+        if len(self.pending_cell_idxs):
+            d = scipy.spatial.distance.cdist(pts, self.pending_pts)
+            dists.append(d)
+            cell_idxs.append(numpy.broadcast_to(
+                self.pending_cell_idxs, d.shape))
+        dists = numpy.concatenate(dists, axis=1)
+        cell_idxs = numpy.concatenate(cell_idxs, axis=1)
+
+        # pad to k and keep the k nearest of tree and buffer candidates
+        n_missing = k - dists.shape[1]
+        if n_missing > 0:
+            dists = numpy.pad(
+                dists, ((0, 0), (0, n_missing)), constant_values=numpy.inf)
+            cell_idxs = numpy.pad(
+                cell_idxs, ((0, 0), (0, n_missing)), constant_values=-1)
+        order = numpy.argsort(dists, axis=1, kind="stable")[:, :k]
+        return (numpy.take_along_axis(dists, order, axis=1),
+                numpy.take_along_axis(cell_idxs, order, axis=1))
+
+    def query_radius(self, pts, r):
+        if self.tree is not None:
+            tree_hits = self.tree.query_ball_point(pts, r)
+        else:
+            tree_hits = [[] for _ in range(len(pts))]
+        pending_mask = (
+            scipy.spatial.distance.cdist(pts, self.pending_pts) <= r
+            if len(self.pending_cell_idxs)
+            else numpy.zeros((len(pts), 0), dtype=bool))
+        return [
+            numpy.concatenate([
+                self.tree_cell_idxs[numpy.asarray(hits, dtype=int)],
+                self.pending_cell_idxs[mask]])
+            for hits, mask in zip(tree_hits, pending_mask)]
+
+
+class CiliaSpatialIndex:
+    """kd-tree backed nearest neighbor and radius queries over nm points
+    (tip, base, exit, prox, soma_center) of a cilobj population
+
+    results refer to cells by their position in self.cilobjs.  Cells added
+    with add_cilobjs are queried by brute force until they exceed
+    rebuild_fraction of the indexed points, when the tree is rebuilt.
+    """
+    def __init__(self, cilobjs=(), point_kinds=("tip", "prox", "soma_center"),
+                 rebuild_fraction=0.1, min_rebuild_size=256):
+        self.point_kinds = tuple(point_kinds)
+        self.cilobjs = []
+        self._kind_indexes = {
+            kind: _KindIndex(rebuild_fraction, min_rebuild_size)
+            for kind in self.point_kinds}
+        self.add_cilobjs(cilobjs, rebuild=True)
+
+    @classmethod
+    def from_dataset(cls, dataset, **kwargs):
+        return cls(dataset.cilobjs, **kwargs)
+
+    def __len__(self):
+        return len(self.cilobjs)
+
+    def add_cilobjs(self, cilobjs, rebuild=False):
+        cilobjs = list(cilobjs)
+        table = CiliaAnnotationTable.from_cilobjs(cilobjs)
+        cell_idxs = numpy.arange(len(self.cilobjs),
+                                 len(self.cilobjs) + len(cilobjs))
+        self.cilobjs.extend(cilobjs)
+        for kind, kind_index in self._kind_indexes.items():
+            pts, valid = _table_kind_pts(table, kind)
+            kind_index.add(pts[valid], cell_idxs[valid])
+            if rebuild:
+                kind_index.rebuild()
+
+    def rebuild(self):
+        for kind_index in self._kind_indexes.values():
+            kind_index.rebuild()
+
+    def query_knn(self, pts, k=1, kind="tip"):
+        """(dists, cell_idxs) of shape (N, k) for the k nearest points of
+        kind to each query point, padded with inf/-1"""
+        return self._kind_indexes[kind].query_knn(as_pts_array(pts), k)
+
+    def query_radius(self, pts, r, kind="tip"):
+        """per query point, array of cell indices with a point of kind
+        within r nm"""
+        return self._kind_indexes[kind].query_radius(as_pts_array(pts), r)
+
+    def cilobjs_within(self, pt, r, kind="tip"):
+        return [self.cilobjs[i]
+                for i in self.query_radius([pt], r, kind=kind)[0]]
+
+    def nearest_neighbors(self, kind="tip", from_kind=None, k=1):
+        """for every cell, the k nearest other cells by point kind measured
+        from from_kind (default the same kind) of the cell
+
+        returns (dists, cell_idxs) of shape (len(self), k), inf/-1 where
+        the cell lacks from_kind or there are fewer neighbors
+        """
+        from_kind = kind if from_kind is None else from_kind
+        table = CiliaAnnotationTable.from_cilobjs(self.cilobjs)
+        pts, valid = _table_kind_pts(table, from_kind)
+        query_idxs = numpy.flatnonzero(valid)
+
+        # query one extra neighbor to drop each cell's own point
+        dists, cell_idxs = self._kind_indexes[kind].query_knn(
+            pts[valid], k + 1)
+        is_self = cell_idxs == query_idxs[:, None]
+        is_self[is_self.cumsum(axis=1) > 1] = False
+        keep_order = numpy.argsort(is_self, axis=1, kind="stable")[:, :k]
+
+        out_dists = numpy.full((len(self), k), numpy.inf)
+        out_cell_idxs = numpy.full((len(self), k), -1)
+        out_dists[valid] = numpy.take_along_axis(dists, keep_order, axis=1)
+        out_cell_idxs[valid] = numpy.take_along_axis(
+            cell_idxs, keep_order, axis=1)
+        return out_dists, out_cell_idxs
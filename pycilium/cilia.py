@@ -1,9 +1,95 @@
+import functools
 import json
 
 import numpy
 
 
+def _readonly(value):
+    if isinstance(value, numpy.ndarray):
+        value.flags.writeable = False
+    return value
+
+
+def _writable_copy(value):
+    """copy of a cached read-only array for callers, as arrays were
+    created fresh on each access before caching"""
+    return value.copy() if isinstance(value, numpy.ndarray) else value
+
+
+_shared_voxel_resolutions = {}
+
+
+def _shared_voxel_resolution(voxel_resolution, max_shared=256):
+    """read-only resolution array, shared between cells with equal values"""
+    vres = numpy.array(voxel_resolution)
+    if vres.dtype == object or vres.ndim != 1:
+        return _readonly(vres)
+    key = (vres.dtype.str, *vres.tolist())
+    try:
+        return _shared_voxel_resolutions[key]
+    except KeyError:
+        if len(_shared_voxel_resolutions) >= max_shared:
+            return _readonly(vres)
+        shared = _shared_voxel_resolutions[key] = _readonly(vres)
+        return shared
+
+
+def _cached_property(func):
+    """property memoized (read-only) in the instance cache, which is
+    cleared whenever an attribute it may depend on is reassigned.  Callers
+    get a writable copy of array values."""
+    key = func.__name__
+
+    @functools.wraps(func)
+    def getter(self):
+        if self._cache is None:
+            self._cache = {}
+        try:
+            value = self._cache[key]
+        except KeyError:
+            value = self._cache[key] = _readonly(func(self))
+        return _writable_copy(value)
+    return property(getter)
+
+
+def _invalidating_attribute(name, convert=None, copy=False):
+    slot = "_{}".format(name)
+
+    def fget(self):
+        value = getattr(self, slot)
+        return _writable_copy(value) if copy else value
+
+    def fset(self, value):
+        setattr(self, slot, value if convert is None else convert(value))
+        self._cache = None
+    return property(fget, fset)
+
+
 class CiliaAnalysisAnnotatedCell:
+    """annotated cell with lazily parsed and memoized point annotations
+
+    derived properties are cached on first access and the cache is cleared
+    when an annotation, resolution, soma point or cell type attribute is
+    reassigned.  Call invalidate_cache after mutating
+    neuroglancer_pt_annotations in place.
+    """
+    __slots__ = (
+        "_neuroglancer_pt_annotations", "_voxel_resolution",
+        "static_cilium_seg_id", "static_soma_seg_id",
+        "dynamic_cilium_seg_id", "dynamic_soma_seg_id",
+        "valence_cell_type", "_extended_cell_type",
+        "_soma_valence_pt_pix", "_soma_centroid_pix",
+        "_soma_center_mass_pix", "metadata", "cellname", "_cache")
+
+    neuroglancer_pt_annotations = _invalidating_attribute(
+        "neuroglancer_pt_annotations")
+    voxel_resolution = _invalidating_attribute(
+        "voxel_resolution", _shared_voxel_resolution, copy=True)
+    extended_cell_type = _invalidating_attribute("extended_cell_type")
+    soma_valence_pt_pix = _invalidating_attribute("soma_valence_pt_pix")
+    soma_centroid_pix = _invalidating_attribute("soma_centroid_pix")
+    soma_center_mass_pix = _invalidating_attribute("soma_center_mass_pix")
+
     def __init__(self, neuroglancer_pt_annotations=None,
                  static_cilium_seg_id=None, static_soma_seg_id=None,
                  dynamic_cilium_seg_id=None, dynamic_soma_seg_id=None,
@@ -11,9 +97,10 @@ class CiliaAnalysisAnnotatedCell:
                  soma_centroid_pix=None, soma_center_mass_pix=None,
                  valence_cell_type=None, extended_cell_type=None,
                  voxel_resolution=None, metadata=None, cellname=None):
+        self._cache = None
 
         self.neuroglancer_pt_annotations = neuroglancer_pt_annotations
-        self.voxel_resolution = numpy.array(voxel_resolution)
+        self.voxel_resolution = voxel_resolution
 
         self.static_cilium_seg_id = static_cilium_seg_id
         self.static_soma_seg_id = static_soma_seg_id
@@ -29,68 +116,90 @@ class CiliaAnalysisAnnotatedCell:
         self.metadata = ({} if metadata is None else metadata)
         self.cellname = cellname
 
+    def invalidate_cache(self):
+        self._cache = None
+
+    # pickle by public attributes so the state does not depend on slots
+    #   (and pickles made before slots were introduced still load)
+    def __getstate__(self):
+        return self._to_dict()
+
+    def __setstate__(self, state):
+        self._cache = None
+        kwargs = {k.lstrip("_"): v for k, v in state.items()
+                  if k != "_cache"}
+        self.__init__(**kwargs)
+
     # these return None if things don't exist...
     def get_ptannotation(self, anno):
-        pt = self.neuroglancer_pt_annotations.get(anno)
-        return pt if pt is None else numpy.array(pt)
+        key = "pt:{}".format(anno)
+        if self._cache is None:
+            self._cache = {}
+        try:
+            pt = self._cache[key]
+        except KeyError:
+            pt = self.neuroglancer_pt_annotations.get(anno)
+            pt = self._cache[key] = _readonly(
+                pt if pt is None else numpy.array(pt))
+        return _writable_copy(pt)
 
     def nm_scale(self, pt, allow_none=True):
         return (pt if pt is None and allow_none
-                else pt * self.voxel_resolution)
+                else pt * self._voxel_resolution)
 
-    @property
+    @_cached_property
     def tip_pix(self):
         return self.get_ptannotation("tip")
 
-    @property
+    @_cached_property
     def tip_nm(self):
         return self.nm_scale(self.tip_pix)
 
-    @property
+    @_cached_property
     def base_pix(self):
         return self.get_ptannotation("base")
 
-    @property
+    @_cached_property
     def base_nm(self):
         return self.nm_scale(self.base_pix)
 
-    @property
+    @_cached_property
     def exit_pix(self):
         return self.get_ptannotation("exit")
 
-    @property
+    @_cached_property
     def exit_nm(self):
         return self.nm_scale(self.exit_pix)
 
-    @property
+    @_cached_property
     def exit_or_base_pix(self):
         return self.base_pix if self.exit_pix is None else self.exit_pix
 
-    @property
+    @_cached_property
     def exit_or_base_nm(self):
         return self.nm_scale(self.exit_or_base_pix)
 
-    @property
+    @_cached_property
     def d_cent_pix(self):
         return self.get_ptannotation("d_cent")
 
-    @property
+    @_cached_property
     def d_cent_nm(self):
         return self.nm_scale(self.d_cent_pix)
 
-    @property
+    @_cached_property
     def soma_centroid_nm(self):
         return self.nm_scale(self.soma_centroid_pix)
 
-    @property
+    @_cached_property
     def soma_center_mass_nm(self):
         return self.nm_scale(self.soma_center_mass_pix)
 
-    @property
+    @_cached_property
     def soma_valence_pt_nm(self):
         return self.nm_scale(self.soma_valence_pt_pix)
 
-    @property
+    @_cached_property
     def soma_center_pt_nm(self):
         if self.soma_centroid_nm is None:
             if self.soma_center_mass_nm is None:
@@ -98,7 +207,7 @@ class CiliaAnalysisAnnotatedCell:
             return self.soma_center_mass_nm
         return self.soma_centroid_nm
 
-    @property
+    @_cached_property
     def prox_nm(self):
         """most proximal point at which cilium exits soma -- base or exit"""
         return self.base_nm if self.exit_nm is None else self.exit_nm
@@ -113,24 +222,24 @@ class CiliaAnalysisAnnotatedCell:
         x, y = disp[:2]
         return numpy.arctan2(y, x)
 
-    @property
+    @_cached_property
     def is_ciliated(self):
         return self.tip_pix is not None and self.prox_nm is not None
 
-    @property
+    @_cached_property
     def has_pocket(self):
         return self.exit_pix is not None
 
-    @property
+    @_cached_property
     def has_mother(self):
         return self.base_pix is not None
 
-    @property
+    @_cached_property
     def has_daughter(self):
         return self.d_cent_pix is not None
 
     # FIXME this is not sufficiently general
-    @property
+    @_cached_property
     def pocket_concealed_surface(self):
         return None if not self.is_ciliated else (
             "pocket" if self.has_pocket else (
@@ -181,4 +290,244 @@ def cilobj_surface_pocket_concealed(cilobj):
     pocket_concealed_surface = None if not ciliated else (
         "pocket" if pocket else (
             "concealed" if cell_type == "OPC" else "surface"))
-    return pocket_concealed_surface
\ No newline at end of file
+    return pocket_concealed_surface
+
+
+class CiliaAnnotationTable:
+    """struct-of-arrays view of a population of CiliaAnalysisAnnotatedCell
+
+    annotation points are held as Nx3 float arrays in pixel space (NaN where
+    missing) with a boolean validity mask per point, so derived quantities
+    are computed for the whole population at once.
+    """
+    pt_annotation_keys = ("tip", "base", "exit", "d_cent")
+    soma_pt_keys = ("soma_valence_pt", "soma_centroid", "soma_center_mass")
+    field_keys = (
+        "static_cilium_seg_id", "static_soma_seg_id",
+        "dynamic_cilium_seg_id", "dynamic_soma_seg_id",
+        "valence_cell_type", "extended_cell_type",
+        "metadata", "cellname")
+
+    def __init__(self, pts_pix, voxel_resolution, pts_valid=None,
+                 annotation_extras=None, **fields):
+        self.pts_pix = {
+            k: numpy.asarray(v, dtype=float).reshape(-1, 3)
+            for k, v in pts_pix.items()}
+        n = len(voxel_resolution)
+        for k in self.pt_annotation_keys + self.soma_pt_keys:
+            self.pts_pix.setdefault(k, numpy.full((n, 3), numpy.nan))
+
+        pts_valid = {} if pts_valid is None else pts_valid
+        self.pts_valid = {
+            k: (numpy.asarray(pts_valid[k], dtype=bool) if k in pts_valid
+                else ~numpy.isnan(v).any(axis=1))
+            for k, v in self.pts_pix.items()}
+
+        self.voxel_resolution = numpy.asarray(
+            voxel_resolution, dtype=float).reshape(-1, 3)
+        self.annotation_extras = _object_column(annotation_extras, n)
+        for k in self.field_keys:
+            setattr(self, k, _object_column(fields.get(k), n))
+
+    def __len__(self):
+        return self.voxel_resolution.shape[0]
+
+    def __getitem__(self, idx):
+        """select rows by index, slice or boolean mask"""
+        if not isinstance(idx, slice) and numpy.ndim(idx) == 0:
+            idx = [idx]
+        return self.__class__(
+            {k: v[idx] for k, v in self.pts_pix.items()},
+            self.voxel_resolution[idx],
+            pts_valid={k: v[idx] for k, v in self.pts_valid.items()},
+            annotation_extras=self.annotation_extras[idx],
+            **{k: getattr(self, k)[idx] for k in self.field_keys})
+
+    @classmethod
+    def from_cilobjs(cls, cilobjs):
+        cilobjs = list(cilobjs)
+        n = len(cilobjs)
+        keys = cls.pt_annotation_keys + cls.soma_pt_keys
+        pts_pix = {k: numpy.full((n, 3), numpy.nan) for k in keys}
+        voxel_resolution = numpy.full((n, 3), numpy.nan)
+        annotation_extras = numpy.empty(n, dtype=object)
+
+        for i, cilobj in enumerate(cilobjs):
+            annos = cilobj.neuroglancer_pt_annotations
+            if annos is not None:
+                for k in cls.pt_annotation_keys:
+                    pt = annos.get(k)
+                    if pt is not None:
+                        pts_pix[k][i] = pt
+                annotation_extras[i] = {
+                    k: v for k, v in annos.items()
+                    if k not in cls.pt_annotation_keys}
+            for k in cls.soma_pt_keys:
+                pt = getattr(cilobj, "{}_pix".format(k))
+                if pt is not None:
+                    pts_pix[k][i] = pt
+            vres = numpy.asarray(cilobj.voxel_resolution)
+            if vres.shape == (3,):
+                voxel_resolution[i] = vres
+
+        return cls(
+            pts_pix, voxel_resolution,
+            annotation_extras=annotation_extras,
+            **{k: [getattr(cilobj, k) for cilobj in cilobjs]
+               for k in cls.field_keys})
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        return cls.from_cilobjs(dataset.cilobjs)
+
+    def _row_pt(self, k, i):
+        return self.pts_pix[k][i] if self.pts_valid[k][i] else None
+
+    def to_cilobjs(self):
+        cilobjs = []
+        for i in range(len(self)):
+            extras = self.annotation_extras[i]
+            pt_annos = {
+                k: self.pts_pix[k][i].tolist()
+                for k in self.pt_annotation_keys if self.pts_valid[k][i]}
+            vres = self.voxel_resolution[i]
+            cilobjs.append(CiliaAnalysisAnnotatedCell(
+                neuroglancer_pt_annotations=(
+                    None if extras is None and not pt_annos
+                    else dict(extras or {}, **pt_annos)),
+                voxel_resolution=(
+                    None if numpy.isnan(vres).any() else vres),
+                soma_valence_pt_pix=self._row_pt("soma_valence_pt", i),
+                soma_centroid_pix=self._row_pt("soma_centroid", i),
+                soma_center_mass_pix=self._row_pt("soma_center_mass", i),
+                **{k: getattr(self, k)[i] for k in self.field_keys}))
+        return cilobjs
+
+    # NaN rows stay NaN, so nm columns carry the same validity as pix
+    def nm_scale(self, pts):
+        return pts * self.voxel_resolution
+
+    @staticmethod
+    def _coalesce(*pts_valid):
+        """first valid point per row from (pts, valid) pairs in order"""
+        pts, valid = pts_valid[-1]
+        for fallback_pts, fallback_valid in pts_valid[-2::-1]:
+            pts = numpy.where(fallback_valid[:, None], fallback_pts, pts)
+            valid = fallback_valid | valid
+        return pts, valid
+
+    @property
+    def tip_pix(self):
+        return self.pts_pix["tip"]
+
+    @property
+    def tip_nm(self):
+        return self.nm_scale(self.tip_pix)
+
+    @property
+    def base_pix(self):
+        return self.pts_pix["base"]
+
+    @property
+    def base_nm(self):
+        return self.nm_scale(self.base_pix)
+
+    @property
+    def exit_pix(self):
+        return self.pts_pix["exit"]
+
+    @property
+    def exit_nm(self):
+        return self.nm_scale(self.exit_pix)
+
+    @property
+    def d_cent_pix(self):
+        return self.pts_pix["d_cent"]
+
+    @property
+    def d_cent_nm(self):
+        return self.nm_scale(self.d_cent_pix)
+
+    @property
+    def exit_or_base_pix(self):
+        return self._coalesce(
+            (self.exit_pix, self.has_pocket),
+            (self.base_pix, self.has_mother))[0]
+
+    @property
+    def exit_or_base_nm(self):
+        return self.nm_scale(self.exit_or_base_pix)
+
+    @property
+    def prox_nm(self):
+        """most proximal point at which cilium exits soma -- base or exit"""
+        return self.exit_or_base_nm
+
+    @property
+    def prox_valid(self):
+        return self.has_pocket | self.has_mother
+
+    @property
+    def soma_centroid_nm(self):
+        return self.nm_scale(self.pts_pix["soma_centroid"])
+
+    @property
+    def soma_center_mass_nm(self):
+        return self.nm_scale(self.pts_pix["soma_center_mass"])
+
+    @property
+    def soma_valence_pt_nm(self):
+        return self.nm_scale(self.pts_pix["soma_valence_pt"])
+
+    @property
+    def soma_center_pt_nm(self):
+        return self.nm_scale(self._coalesce(*(
+            (self.pts_pix[k], self.pts_valid[k]) for k in (
+                "soma_centroid", "soma_center_mass", "soma_valence_pt")))[0])
+
+    @property
+    def soma_center_pt_valid(self):
+        return (self.pts_valid["soma_centroid"] |
+                self.pts_valid["soma_center_mass"] |
+                self.pts_valid["soma_valence_pt"])
+
+    @property
+    def is_ciliated(self):
+        return self.pts_valid["tip"] & self.prox_valid
+
+    @property
+    def has_pocket(self):
+        return self.pts_valid["exit"]
+
+    @property
+    def has_mother(self):
+        return self.pts_valid["base"]
+
+    @property
+    def has_daughter(self):
+        return self.pts_valid["d_cent"]
+
+    @property
+    def pocket_concealed_surface(self):
+        pcs = numpy.full(len(self), None, dtype=object)
+        ciliated = self.is_ciliated
+        pocket = ciliated & self.has_pocket
+        concealed = (
+            ciliated & ~self.has_pocket & (self.extended_cell_type == "OPC"))
+        pcs[ciliated] = "surface"
+        pcs[concealed] = "concealed"
+        pcs[pocket] = "pocket"
+        return pcs
+
+    def __repr__(self):
+        return "CiliaAnnotationTable({} cells, {} ciliated)".format(
+            len(self), int(self.is_ciliated.sum()))
+
+
+def _object_column(values, n):
+    col = numpy.full(n, None, dtype=object)
+    if values is not None:
+        # assign elementwise so list-like values are not broadcast
+        for i, v in enumerate(values):
+            col[i] = v
+    return col
@@ -1,8 +1,220 @@
+import collections.abc
 import dataclasses
 import pathlib
 import pickle
 
 
+class _LazyPickleComponent:
+    """dataset component unpickled in full on first access"""
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._data = None
+
+    @property
+    def resident(self):
+        return self._data is not None
+
+    def load(self):
+        if self._data is None:
+            with self.path.open("rb") as f:
+                self._data = pickle.load(f)
+        return self._data
+
+    def release(self):
+        self._data = None
+
+    def __repr__(self):
+        return "{}({}, resident={})".format(
+            self.__class__.__name__, self.path, self.resident)
+
+
+class LazyPickleMapping(_LazyPickleComponent, collections.abc.Mapping):
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def keys(self):
+        return self.load().keys()
+
+
+class LazyPickleSequence(_LazyPickleComponent, collections.abc.Sequence):
+    def __getitem__(self, idx):
+        return self.load()[idx]
+
+    def __len__(self):
+        return len(self.load())
+
+
+class PickleDirectoryMapping(collections.abc.Mapping):
+    """mapping stored as one pickle per key in a directory, with an index
+    pickle of key to filename, so single values load without the rest"""
+    index_filename = "index.pkl"
+
+    def __init__(self, path, keep_resident=True):
+        self.path = pathlib.Path(path)
+        self.keep_resident = keep_resident
+        with (self.path / self.index_filename).open("rb") as f:
+            self._index = pickle.load(f)
+        self._resident = {}
+
+    @classmethod
+    def is_pickle_directory(cls, path):
+        return (pathlib.Path(path) / cls.index_filename).is_file()
+
+    @classmethod
+    def write(cls, d, path):
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        index = {}
+        for i, (k, v) in enumerate(d.items()):
+            index[k] = "{}.pkl".format(i)
+            with (path / index[k]).open("wb") as f:
+                pickle.dump(v, f)
+        with (path / cls.index_filename).open("wb") as f:
+            pickle.dump(index, f)
+        return cls(path)
+
+    @property
+    def resident_keys(self):
+        return self._resident.keys()
+
+    @property
+    def resident(self):
+        return len(self._resident) == len(self._index)
+
+    def load(self):
+        return {k: self[k] for k in self}
+
+    def release(self):
+        self._resident = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._resident[key]
+        except KeyError:
+            pass
+        with (self.path / self._index[key]).open("rb") as f:
+            value = pickle.load(f)
+        if self.keep_resident:
+            self._resident[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def __repr__(self):
+        return "{}({}, {}/{} resident)".format(
+            self.__class__.__name__, self.path,
+            len(self._resident), len(self._index))
+
+
+class CilobjIndex:
+    """secondary indexes of cilobjs by attribute value
+
+    each indexed attribute maps value to the set of row ids holding it, so
+    combined queries are set intersections.  Row ids increase in insertion
+    order.  Call update after changing an indexed attribute of a cilobj.
+    """
+    default_attrs = (
+        "valence_cell_type", "extended_cell_type",
+        "pocket_concealed_surface", "is_ciliated")
+
+    def __init__(self, cilobjs=(), attrs=None):
+        self.attrs = tuple(self.default_attrs if attrs is None else attrs)
+        self._value_to_rows = {attr: {} for attr in self.attrs}
+        self._row_to_cilobj = {}
+        self._row_to_values = {}
+        self._cilobj_id_to_row = {}
+        self._next_row = 0
+        for cilobj in cilobjs:
+            self.add(cilobj)
+
+    def __len__(self):
+        return len(self._row_to_cilobj)
+
+    def __contains__(self, cilobj):
+        return id(cilobj) in self._cilobj_id_to_row
+
+    def _index_row(self, row, cilobj):
+        values = tuple(getattr(cilobj, attr) for attr in self.attrs)
+        for attr, value in zip(self.attrs, values):
+            try:
+                self._value_to_rows[attr][value].add(row)
+            except KeyError:
+                self._value_to_rows[attr][value] = {row}
+        self._row_to_values[row] = values
+
+    def _unindex_row(self, row):
+        for attr, value in zip(self.attrs, self._row_to_values.pop(row)):
+            rows = self._value_to_rows[attr][value]
+            rows.discard(row)
+            if not rows:
+                del self._value_to_rows[attr][value]
+
+    def add(self, cilobj):
+        if cilobj in self:
+            return
+        row = self._next_row
+        self._next_row += 1
+        self._row_to_cilobj[row] = cilobj
+        self._cilobj_id_to_row[id(cilobj)] = row
+        self._index_row(row, cilobj)
+
+    def remove(self, cilobj):
+        row = self._cilobj_id_to_row.pop(id(cilobj))
+        del self._row_to_cilobj[row]
+        self._unindex_row(row)
+
+    def update(self, cilobj):
+        row = self._cilobj_id_to_row[id(cilobj)]
+        self._unindex_row(row)
+        self._index_row(row, cilobj)
+
+    def values(self, attr):
+        return self._value_to_rows[attr].keys()
+
+    def rows(self, **criteria):
+        """row ids matching all criteria, given as attr=value or
+        attr={value, ...} to match any of several values"""
+        rows = None
+        for attr, value in criteria.items():
+            if isinstance(value, (set, frozenset, list)):
+                attr_rows = set().union(*(
+                    self._value_to_rows[attr].get(v, ()) for v in value))
+            else:
+                attr_rows = self._value_to_rows[attr].get(value, set())
+            rows = attr_rows if rows is None else (rows & attr_rows)
+        return set(self._row_to_cilobj) if rows is None else rows
+
+    def cilobjs(self, rows):
+        return [self._row_to_cilobj[row] for row in sorted(rows)]
+
+    def query(self, **criteria):
+        return self.cilobjs(self.rows(**criteria))
+
+    def group_by(self, attr, rows=None):
+        """attr value to list of cilobjs, optionally restricted to rows"""
+        return {
+            value: self.cilobjs(
+                value_rows if rows is None else (value_rows & rows))
+            for value, value_rows in self._value_to_rows[attr].items()
+            if rows is None or not value_rows.isdisjoint(rows)}
+
+
 @dataclasses.dataclass
 class CiliaAnalysisDataset:
     cilobjs_array: list
@@ -10,16 +222,30 @@ class CiliaAnalysisDataset:
     cn_to_skelcd: dict
     cn_to_mpskel: dict
     cn_to_bbox_mesh: dict
-        
+    _index: CilobjIndex = dataclasses.field(
+        default=None, init=False, repr=False, compare=False)
+    _index_ids: list = dataclasses.field(
+        default=None, init=False, repr=False, compare=False)
+
+    # on-disk names for each component in order of preference
+    component_filestems = {
+        "cilobjs_array": ("cilobjs_array",),
+        "cn_to_cilobj": ("cn_to_cilobj",),
+        "cn_to_skelcd": ("cn_to_skelcd",),
+        "cn_to_mpskel": ("cn_to_mpskel_w_radius", "cn_to_mpskel"),
+        "cn_to_bbox_mesh": ("cn_to_bbox_mesh",),
+    }
+    optional_components = {"cn_to_bbox_mesh"}
+
     @property
     def cellnames(self):
         return (
-            self.cn_to_cilobj.keys() | 
+            self.cn_to_cilobj.keys() |
             self.cn_to_skelcd.keys() |
             self.cn_to_mpskel.keys() |
             self.cn_to_bbox_mesh.keys()
         )
-    
+
     @property
     def named_cilobjs(self):
         return [*self.cn_to_cilobj.values()]
@@ -28,6 +254,22 @@ class CiliaAnalysisDataset:
     def cilobjs(self):
         return self.cilobjs_array[:]
 
+    @property
+    def resident_components(self):
+        """component name to whether it is fully loaded in memory"""
+        return {
+            name: getattr(getattr(self, name), "resident", True)
+            for name in self.component_filestems}
+
+    def get_skelcd(self, cellname):
+        return self.cn_to_skelcd[cellname]
+
+    def get_mpskel(self, cellname):
+        return self.cn_to_mpskel[cellname]
+
+    def get_bbox_mesh(self, cellname):
+        return self.cn_to_bbox_mesh[cellname]
+
     @staticmethod
     def _celltype_to_cilobj(cilobjs, ct_attr=None):
         ct_attr = ct_attr or "valence_cell_type"
@@ -40,35 +282,112 @@ class CiliaAnalysisDataset:
                 ct_to_cilobj[ct] = [cilobj]
         return ct_to_cilobj
 
-    def celltype_to_cilobj(self, cilobj_filter=None, **kwargs):
+    @property
+    def index(self):
+        """CilobjIndex over cilobjs_array, built on first use and rebuilt
+        when cilobjs_array no longer holds the indexed cilobjs.  Call
+        reindex_cilobj after changing an indexed attribute."""
+        cilobj_ids = [id(cilobj) for cilobj in self.cilobjs_array]
+        if self._index is None or cilobj_ids != self._index_ids:
+            self._index = CilobjIndex(self.cilobjs_array)
+            self._index_ids = cilobj_ids
+        return self._index
+
+    def add_cilobj(self, cilobj):
+        if not isinstance(self.cilobjs_array, list):
+            self.cilobjs_array = list(self.cilobjs_array)
+        self.cilobjs_array.append(cilobj)
+        if cilobj.cellname is not None:
+            if not isinstance(self.cn_to_cilobj, dict):
+                self.cn_to_cilobj = dict(self.cn_to_cilobj)
+            self.cn_to_cilobj[cilobj.cellname] = cilobj
+        if self._index is not None:
+            self._index.add(cilobj)
+            self._index_ids.append(id(cilobj))
+
+    def remove_cilobj(self, cilobj):
+        if not isinstance(self.cilobjs_array, list):
+            self.cilobjs_array = list(self.cilobjs_array)
+        self.cilobjs_array.remove(cilobj)
+        if self.cn_to_cilobj.get(cilobj.cellname) is cilobj:
+            if not isinstance(self.cn_to_cilobj, dict):
+                self.cn_to_cilobj = dict(self.cn_to_cilobj)
+            del self.cn_to_cilobj[cilobj.cellname]
+        if self._index is not None:
+            self._index.remove(cilobj)
+            self._index_ids.remove(id(cilobj))
+
+    def reindex_cilobj(self, cilobj):
+        """refresh index entries after changing an indexed attribute"""
+        if self._index is not None:
+            self._index.update(cilobj)
+
+    def query(self, **criteria):
+        """cilobjs matching all criteria on indexed attributes, e.g.
+        query(valence_cell_type="E", is_ciliated=True)"""
+        return self.index.query(**criteria)
+
+    def celltype_to_cilobj(self, cilobj_filter=None, ct_attr=None,
+                           **criteria):
+        """group cilobjs by ct_attr (default valence_cell_type).  Indexed
+        criteria narrow the candidates through the index before
+        cilobj_filter is applied."""
         cilobj_filter = cilobj_filter or (lambda x: x)
-        return self._celltype_to_cilobj(filter(cilobj_filter, self.cilobjs), **kwargs)
-    
+        cilobjs = (self.index.query(**criteria) if criteria
+                   else self.cilobjs)
+        return self._celltype_to_cilobj(
+            filter(cilobj_filter, cilobjs), ct_attr=ct_attr)
+
     @classmethod
-    def from_path(cls, p):
+    def _lazy_component(cls, path, name):
+        for stem in cls.component_filestems[name]:
+            if PickleDirectoryMapping.is_pickle_directory(path / stem):
+                return PickleDirectoryMapping(path / stem)
+            pkl_path = path / "{}.pkl".format(stem)
+            if pkl_path.is_file():
+                return (LazyPickleSequence(pkl_path)
+                        if name == "cilobjs_array"
+                        else LazyPickleMapping(pkl_path))
+        if name in cls.optional_components:
+            print("no {} found in {}".format(name, path))
+            return {}
+        raise FileNotFoundError(
+            "no {} found in {}".format(name, path))
+
+    @classmethod
+    def from_path(cls, p, lazy=False):
+        """load a dataset directory.  If lazy, each component is read on
+        first access and components stored as per-cellname pickle
+        directories are read one cell at a time.  Chunked binary datasets
+        (see pycilium.utils.chunked_store) are always memory mapped."""
         path = pathlib.Path(p)
-        with (path / "cilobjs_array.pkl").open("rb") as f:
-            cilobjs_array = pickle.load(f)
-        with (path / "cn_to_cilobj.pkl").open("rb") as f:
-            cn_to_cilobj = pickle.load(f)
-        with (path / "cn_to_skelcd.pkl").open("rb") as f:
-            cn_to_skelcd = pickle.load(f)
-        try:
-            with (path / "cn_to_mpskel_w_radius.pkl").open("rb") as f:
-                cn_to_mpskel = pickle.load(f)
-        except:
-            with (path / "cn_to_mpskel.pkl").open("rb") as f:
-                cn_to_mpskel = pickle.load(f)
-        try:
-            with (path / "cn_to_bbox_mesh.pkl").open("rb") as f:
-                cn_to_bbox_mesh = pickle.load(f)
-        except Exception as e:
-            print(e)
-            cn_to_bbox_mesh = {}
-        return cls(
-            cilobjs_array=cilobjs_array,
-            cn_to_cilobj=cn_to_cilobj,
-            cn_to_skelcd=cn_to_skelcd,
-            cn_to_mpskel=cn_to_mpskel,
-            cn_to_bbox_mesh=cn_to_bbox_mesh
-        )
+        if (path / "manifest.json").is_file():
+            # chunked_store requires meshparty, so only import it when needed
+            from pycilium.utils import chunked_store
+            return chunked_store.read_chunked_dataset(path, cls)
+        components = {
+            name: cls._lazy_component(path, name)
+            for name in cls.component_filestems}
+        if not lazy:
+            components = {
+                name: getattr(component, "load", lambda: component)()
+                for name, component in components.items()}
+        return cls(**components)
+
+    def to_path(self, p, per_key_components=(
+            "cn_to_skelcd", "cn_to_mpskel", "cn_to_bbox_mesh")):
+        """write the dataset directory read by from_path, storing
+        per_key_components as per-cellname pickle directories"""
+        path = pathlib.Path(p)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in self.component_filestems:
+            component = getattr(self, name)
+            if name in per_key_components:
+                PickleDirectoryMapping.write(component, path / name)
+                continue
+            if name == "cilobjs_array":
+                component = list(component)
+            else:
+                component = dict(component)
+            with (path / "{}.pkl".format(name)).open("wb") as f:
+                pickle.dump(component, f)
@@ -0,0 +1,374 @@
+"""
+chunked binary storage for analysis datasets
+
+per-cell arrays (mesh vertices/faces, skeleton vertices/edges/radius) are
+concatenated into .npy files per chunk of cells with an offsets array per
+field, so a single cell is read as a zero-copy slice of a memory map.  A
+small json manifest describes the layout.
+"""
+import collections.abc
+import json
+import pathlib
+
+import numpy
+
+import meshparty.skeleton
+import meshparty.trimesh_io
+
+import pycilium.cilia
+from pycilium.utils.analysis_utils import CiliaAnalysisDataset
+from pycilium.utils.packed_skeletons import PackedSkeletonStore
+from pycilium.utils.serialize import CiliaAnalysisJsonEncoder
+
+DATASET_FORMAT = "pycilium-chunked-dataset"
+DATASET_FORMAT_VERSION = 2
+MANIFEST_FILENAME = "manifest.json"
+STORE_FILENAME = "store.json"
+
+
+class ChunkedArrayStore:
+    """sequence of items, each a dict of field name to array, stored as
+    per-chunk concatenated arrays with offsets
+
+    fields maps field name to (dtype, trailing shape), e.g.
+    {"vertices": ("float64", (3,))}
+    """
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with (self.path / STORE_FILENAME).open("r") as f:
+            store_d = json.load(f)
+        self.fields = {
+            k: (numpy.dtype(dtype), tuple(shape))
+            for k, (dtype, shape) in store_d["fields"].items()}
+        self.chunks = store_d["chunks"]
+        self.metadata = store_d.get("metadata", {})
+        self._chunk_starts = numpy.cumsum(
+            [0] + [c["n_items"] for c in self.chunks])
+        self._chunk_arrays = {}
+
+    def __len__(self):
+        return int(self._chunk_starts[-1])
+
+    @staticmethod
+    def _chunk_name(i):
+        return "chunk_{:06d}".format(i)
+
+    @classmethod
+    def _write_chunk(cls, path, chunk_idx, fields, items):
+        chunk_path = path / cls._chunk_name(chunk_idx)
+        chunk_path.mkdir(parents=True, exist_ok=True)
+        for field, (dtype, shape) in fields.items():
+            arrs = [numpy.asarray(item[field], dtype=dtype).reshape(
+                -1, *shape) for item in items]
+            offsets = numpy.cumsum(
+                [0] + [len(arr) for arr in arrs], dtype=numpy.int64)
+            data = (numpy.concatenate(arrs) if arrs
+                    else numpy.empty((0, *shape), dtype=dtype))
+            numpy.save(chunk_path / "{}.npy".format(field), data)
+            numpy.save(chunk_path / "{}.offsets.npy".format(field), offsets)
+        return {"path": chunk_path.name, "n_items": len(items)}
+
+    @classmethod
+    def write(cls, path, items, fields, items_per_chunk=1024,
+              metadata=None):
+        """write an iterable of {field: array} items, holding at most one
+        chunk of items in memory"""
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        fields = {k: (numpy.dtype(dtype).str, tuple(shape))
+                  for k, (dtype, shape) in fields.items()}
+
+        chunks = []
+        chunk_items = []
+        for item in items:
+            chunk_items.append(item)
+            if len(chunk_items) >= items_per_chunk:
+                chunks.append(cls._write_chunk(
+                    path, len(chunks), fields, chunk_items))
+                chunk_items = []
+        if chunk_items:
+            chunks.append(cls._write_chunk(
+                path, len(chunks), fields, chunk_items))
+
+        with (path / STORE_FILENAME).open("w") as f:
+            json.dump({
+                "fields": {k: [dtype, list(shape)]
+                           for k, (dtype, shape) in fields.items()},
+                "chunks": chunks,
+                "metadata": ({} if metadata is None else metadata)
+            }, f, cls=CiliaAnalysisJsonEncoder)
+        return cls(path)
+
+    def _get_chunk_arrays(self, chunk_idx):
+        try:
+            return self._chunk_arrays[chunk_idx]
+        except KeyError:
+            chunk_path = self.path / self.chunks[chunk_idx]["path"]
+            arrays = {
+                field: (
+                    numpy.load(chunk_path / "{}.npy".format(field),
+                               mmap_mode="r"),
+                    numpy.load(chunk_path / "{}.offsets.npy".format(field)))
+                for field in self.fields}
+            self._chunk_arrays[chunk_idx] = arrays
+            return arrays
+
+    def get_arrays(self, item_idx):
+        """field name to read-only view of this item's rows"""
+        if not 0 <= item_idx < len(self):
+            raise IndexError(item_idx)
+        chunk_idx = int(numpy.searchsorted(
+            self._chunk_starts, item_idx, side="right")) - 1
+        local_idx = item_idx - self._chunk_starts[chunk_idx]
+        return {
+            field: data[offsets[local_idx]:offsets[local_idx + 1]]
+            for field, (data, offsets)
+            in self._get_chunk_arrays(chunk_idx).items()}
+
+
+class _ChunkedMapping(collections.abc.Mapping):
+    """cellname mapping over a ChunkedArrayStore.  Cells are listed in the
+    store metadata so that keys are known without reading arrays."""
+    # data is memory mapped, so nothing is held resident
+    resident = False
+
+    def __init__(self, path):
+        self.store = ChunkedArrayStore(path)
+        self._cells = {
+            _json_key(cell[0]): cell[1:]
+            for cell in self.store.metadata["cells"]}
+
+    def __iter__(self):
+        return iter(self._cells)
+
+    def __len__(self):
+        return len(self._cells)
+
+    def __contains__(self, key):
+        return key in self._cells
+
+    def keys(self):
+        return self._cells.keys()
+
+    def __repr__(self):
+        return "{}({}, {} cells)".format(
+            self.__class__.__name__, self.store.path, len(self))
+
+
+class ChunkedMeshMapping(_ChunkedMapping):
+    """cellname to mesh, or to dict/list of meshes (or None), as stored in
+    cn_to_bbox_mesh"""
+    fields = {
+        "vertices": (numpy.float64, (3,)),
+        "faces": (numpy.int64, (3,))}
+
+    @classmethod
+    def write(cls, path, cn_to_mesh, **kwargs):
+        cells = []
+        meshes = []
+        for cn, value in cn_to_mesh.items():
+            if value is None:
+                cells.append([cn, None, []])
+                continue
+            if isinstance(value, collections.abc.Mapping):
+                container, keyed_meshes = "dict", value.items()
+            elif isinstance(value, (list, tuple)):
+                container, keyed_meshes = "list", enumerate(value)
+            else:
+                container, keyed_meshes = "mesh", [(None, value)]
+            items = []
+            for k, mesh in keyed_meshes:
+                items.append([_json_key(k), len(meshes)])
+                meshes.append(mesh)
+            cells.append([cn, container, items])
+
+        ChunkedArrayStore.write(
+            path, ({"vertices": mesh.vertices, "faces": mesh.faces}
+                   for mesh in meshes),
+            cls.fields, metadata={"cells": cells}, **kwargs)
+        return cls(path)
+
+    def get_mesh_arrays(self, cellname):
+        """zero-copy (vertices, faces) per mesh as key to arrays, with
+        keys as stored (segids, list positions or None)"""
+        container, items = self._cells[cellname]
+        mesh_arrays = {}
+        for k, idx in items:
+            arrays = self.store.get_arrays(idx)
+            mesh_arrays[_json_key(k)] = (arrays["vertices"], arrays["faces"])
+        return mesh_arrays
+
+    def __getitem__(self, cellname):
+        container, items = self._cells[cellname]
+        if container is None:
+            return None
+        meshes = {
+            k: meshparty.trimesh_io.Mesh(vertices, faces, process=False)
+            for k, (vertices, faces)
+            in self.get_mesh_arrays(cellname).items()}
+        if container == "dict":
+            return meshes
+        if container == "list":
+            return [*meshes.values()]
+        return next(iter(meshes.values()))
+
+
+class ChunkedSkeletonMapping(_ChunkedMapping):
+    """cellname to meshparty skeleton (vertices, edges, root and radius),
+    as stored in cn_to_mpskel"""
+    fields = {
+        "vertices": (numpy.float64, (3,)),
+        "edges": (numpy.int64, (2,)),
+        "radius": (numpy.float64, ())}
+
+    @classmethod
+    def write(cls, path, cn_to_mpskel, **kwargs):
+        cells = []
+        mpskels = []
+        for cn, mpskel in cn_to_mpskel.items():
+            if mpskel is None:
+                cells.append([cn, None, None, False])
+                continue
+            cells.append([cn, len(mpskels), int(mpskel.root),
+                          mpskel.radius is not None])
+            mpskels.append(mpskel)
+
+        ChunkedArrayStore.write(
+            path, ({
+                "vertices": mpskel.vertices,
+                "edges": mpskel.edges,
+                "radius": (numpy.full(len(mpskel.vertices), numpy.nan)
+                           if mpskel.radius is None else mpskel.radius)}
+                   for mpskel in mpskels),
+            cls.fields, metadata={"cells": cells}, **kwargs)
+        return cls(path)
+
+    def get_skeleton_arrays(self, cellname):
+        """zero-copy (vertices, edges, root, radius) or None"""
+        item_idx, root, has_radius = self._cells[cellname]
+        if item_idx is None:
+            return None
+        arrays = self.store.get_arrays(item_idx)
+        return (arrays["vertices"], arrays["edges"], root,
+                arrays["radius"] if has_radius else None)
+
+    def __getitem__(self, cellname):
+        skel_arrays = self.get_skeleton_arrays(cellname)
+        if skel_arrays is None:
+            return None
+        vertices, edges, root, radius = skel_arrays
+        # Skeleton reorients edges in place, so they cannot be a read-only view
+        return meshparty.skeleton.Skeleton(
+            vertices, numpy.array(edges), root=root, radius=radius)
+
+
+def _json_key(k):
+    """keys as they round trip through json (numpy scalars to python,
+    tuples to lists and back to tuples)"""
+    if isinstance(k, numpy.generic):
+        return k.item()
+    if isinstance(k, list):
+        return tuple(_json_key(i) for i in k)
+    return k
+
+
+def is_chunked_dataset(p):
+    return (pathlib.Path(p) / MANIFEST_FILENAME).is_file()
+
+
+def write_chunked_dataset(dataset, p, items_per_chunk=1024):
+    """write a CiliaAnalysisDataset in the chunked layout.  Components
+    that can be released (lazy pickles) are released once written."""
+    path = pathlib.Path(p)
+    path.mkdir(parents=True, exist_ok=True)
+
+    # cn_to_cilobj entries reference cilobjs_array when they are the same
+    #   object, otherwise they are stored after it
+    cilobjs = list(dataset.cilobjs_array)
+    cilobj_id_to_idx = {id(cilobj): i for i, cilobj in enumerate(cilobjs)}
+    cn_to_cilobj_idx = []
+    for cn, cilobj in dataset.cn_to_cilobj.items():
+        try:
+            idx = cilobj_id_to_idx[id(cilobj)]
+        except KeyError:
+            idx = cilobj_id_to_idx[id(cilobj)] = len(cilobjs)
+            cilobjs.append(cilobj)
+        cn_to_cilobj_idx.append([cn, idx])
+    with (path / "cilobjs.json").open("w") as f:
+        json.dump(cilobjs, f, cls=CiliaAnalysisJsonEncoder)
+
+    cn_to_skelcd = dataset.cn_to_skelcd
+    if not isinstance(cn_to_skelcd, PackedSkeletonStore):
+        cn_to_skelcd = PackedSkeletonStore.from_skelcds(cn_to_skelcd)
+    cn_to_skelcd.save(path / "cn_to_skelcd")
+    _release(dataset.cn_to_skelcd)
+
+    ChunkedSkeletonMapping.write(
+        path / "cn_to_mpskel", dataset.cn_to_mpskel,
+        items_per_chunk=items_per_chunk)
+    _release(dataset.cn_to_mpskel)
+    ChunkedMeshMapping.write(
+        path / "cn_to_bbox_mesh", dataset.cn_to_bbox_mesh,
+        items_per_chunk=items_per_chunk)
+    _release(dataset.cn_to_bbox_mesh)
+
+    with (path / MANIFEST_FILENAME).open("w") as f:
+        json.dump({
+            "format": DATASET_FORMAT,
+            "version": DATASET_FORMAT_VERSION,
+            "n_cilobjs_array": len(dataset.cilobjs_array),
+            "cn_to_cilobj": cn_to_cilobj_idx,
+            "components": {
+                "cilobjs": "cilobjs.json",
+                "cn_to_skelcd": "cn_to_skelcd",
+                "cn_to_mpskel": "cn_to_mpskel",
+                "cn_to_bbox_mesh": "cn_to_bbox_mesh"
+            }
+        }, f, cls=CiliaAnalysisJsonEncoder)
+
+
+def read_chunked_dataset(p, dataset_cls=CiliaAnalysisDataset):
+    path = pathlib.Path(p)
+    with (path / MANIFEST_FILENAME).open("r") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != DATASET_FORMAT:
+        raise ValueError("{} is not a {}".format(path, DATASET_FORMAT))
+    if manifest["version"] > DATASET_FORMAT_VERSION:
+        raise ValueError(
+            "unsupported {} version {}".format(
+                DATASET_FORMAT, manifest["version"]))
+    components = manifest["components"]
+
+    with (path / components["cilobjs"]).open("r") as f:
+        cilobjs = [pycilium.cilia.CiliaAnalysisAnnotatedCell._from_dict(d)
+                   for d in json.load(f)]
+    if manifest["version"] < 2:
+        # version 1 stored compact-detail skeletons as json
+        with (path / components["cn_to_skelcd"]).open("r") as f:
+            cn_to_skelcd = {
+                _json_key(cn): skelcd for cn, skelcd in json.load(f)}
+    else:
+        cn_to_skelcd = PackedSkeletonStore.load(
+            path / components["cn_to_skelcd"])
+
+    return dataset_cls(
+        cilobjs_array=cilobjs[:manifest["n_cilobjs_array"]],
+        cn_to_cilobj={_json_key(cn): cilobjs[idx]
+                      for cn, idx in manifest["cn_to_cilobj"]},
+        cn_to_skelcd=cn_to_skelcd,
+        cn_to_mpskel=ChunkedSkeletonMapping(
+            path / components["cn_to_mpskel"]),
+        cn_to_bbox_mesh=ChunkedMeshMapping(
+            path / components["cn_to_bbox_mesh"]))
+
+
+def convert_pickle_dataset(src, dst, **kwargs):
+    """convert a pickle dataset directory to the chunked layout"""
+    write_chunked_dataset(
+        CiliaAnalysisDataset.from_path(src, lazy=True), dst, **kwargs)
+
+
+def _release(component):
+    release = getattr(component, "release", None)
+    if callable(release):
+        release()
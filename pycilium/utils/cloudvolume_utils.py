@@ -1,8 +1,17 @@
+import collections
+import concurrent.futures
+import os
+import threading
+
 import numpy
+import pandas
 
 import cloudvolume
+import cloudvolume.lib
 from cloudvolume.datasource.precomputed.mesh.unsharded import *
 
+from pycilium.utils.mesh_cache import get_default_mesh_cache
+from pycilium.utils.packed_skeletons import skeleton_vertices
 from pycilium.utils.skeleton_utils import *
 
 
@@ -22,19 +31,254 @@ def bbox_from_filename(fn, scale=numpy.array([8, 8, 1])):
         ])
 
 
+def fragment_filename_bounds(fns, scale=numpy.array([8, 8, 1])):
+    """Nx3 min and max corners of bbox_from_filename for many fragment
+    filenames, parsed together"""
+    names = pandas.Series([os.path.basename(fn) for fn in fns], dtype=object)
+    groups = names.str.extract(
+        cloudvolume.lib.FILENAME_RE.pattern).to_numpy().reshape(-1, 6)
+    unmatched = pandas.isna(groups).any(axis=1)
+    if unmatched.any():
+        raise ValueError("Unable to decode bounding box from: {}".format(
+            names[unmatched].iloc[0]))
+    # Bbox.from_filename parses with dtype int, truncating float bounds
+    bounds = groups.astype(float).astype(int).reshape(-1, 3, 2)
+    # as Bbox.from_points of the scaled corners: float32, exclusive max
+    #   corner and int64 truncation
+    corners = numpy.stack(
+        [bounds.min(axis=2) * scale, bounds.max(axis=2) * scale]
+    ).astype(numpy.float32)
+    mins = corners.min(axis=0)
+    maxs = corners.max(axis=0) + numpy.float32(1)
+    return (numpy.minimum(mins, maxs).astype(numpy.int64),
+            numpy.maximum(mins, maxs).astype(numpy.int64))
+
+
+def bounds_included(minpt, maxpt, mins, maxs):
+    """bb_included of the bbox (minpt, maxpt) with each row of mins, maxs"""
+    minpt, maxpt = numpy.asarray(minpt), numpy.asarray(maxpt)
+
+    def contains(lo, hi, pts):
+        return ((pts >= lo) & (pts <= hi)).all(axis=-1)
+
+    return (
+        (contains(minpt, maxpt, mins) & contains(minpt, maxpt, maxs)) |
+        (contains(mins, maxs, minpt) & contains(mins, maxs, maxpt)) |
+        ((minpt < maxs) & (maxpt > mins)).all(axis=-1))
+
+
+class ManifestFragmentIndex:
+    """mesh manifest fragment filenames of a volume with their bounds
+    (as bbox_from_filename) parsed once per segid into arrays, keeping
+    the max_segids most recently used segids.  Manifests are fetched with
+    the cv passed to each call."""
+    def __init__(self, scale=numpy.array([8, 8, 1]), max_segids=2 ** 16):
+        self.scale = numpy.asarray(scale)
+        self.max_segids = max_segids
+        self._segid_fragments = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._segid_fragments)
+
+    def fetch(self, cv, segids):
+        segid_fragments = {}
+        with self._lock:
+            for segid in segids:
+                if segid in self._segid_fragments:
+                    self._segid_fragments.move_to_end(segid)
+                    segid_fragments[segid] = self._segid_fragments[segid]
+        missing = [segid for segid in segids if segid not in segid_fragments]
+        if missing:
+            for segid, manifests in cv.mesh._get_manifests(missing).items():
+                fns = numpy.array(list(manifests), dtype=object)
+                segid_fragments[segid] = (
+                    fns, *fragment_filename_bounds(fns, self.scale))
+            with self._lock:
+                for segid in missing:
+                    if segid in segid_fragments:
+                        self._segid_fragments[segid] = segid_fragments[segid]
+                while len(self._segid_fragments) > self.max_segids:
+                    self._segid_fragments.popitem(last=False)
+        return {segid: segid_fragments[segid] for segid in segids
+                if segid in segid_fragments}
+
+    def intersecting(self, cv, segids, bbox):
+        """{ segid: [fragment filenames] } of fragments intersecting bbox"""
+        return _fragments_intersecting(self.fetch(cv, segids), segids, bbox)
+
+    def clear(self):
+        with self._lock:
+            self._segid_fragments.clear()
+
+
+def _fragments_intersecting(segid_fragments, segids, bbox):
+    return {
+        segid: fns[bounds_included(bbox.minpt, bbox.maxpt, mins, maxs)].tolist()
+        for segid, (fns, mins, maxs) in (
+            (segid, segid_fragments[segid]) for segid in segids
+            if segid in segid_fragments)}
+
+
+MAX_MANIFEST_FRAGMENT_INDEXES = 8
+_manifest_fragment_indexes = collections.OrderedDict()
+_manifest_fragment_indexes_lock = threading.Lock()
+
+
+def get_manifest_fragment_index(cv, scale=numpy.array([8, 8, 1])):
+    """ManifestFragmentIndex shared by calls for the same volume and scale,
+    keeping the MAX_MANIFEST_FRAGMENT_INDEXES most recently used"""
+    key = (_volume_key(cv), tuple(numpy.asarray(scale).tolist()))
+    with _manifest_fragment_indexes_lock:
+        try:
+            _manifest_fragment_indexes.move_to_end(key)
+            return _manifest_fragment_indexes[key]
+        except KeyError:
+            index = _manifest_fragment_indexes[key] = ManifestFragmentIndex(
+                scale=scale)
+            while len(_manifest_fragment_indexes) > MAX_MANIFEST_FRAGMENT_INDEXES:
+                _manifest_fragment_indexes.popitem(last=False)
+            return index
+
+
+def clear_manifest_fragment_indexes():
+    """drop the manifest fragment indexes of all volumes"""
+    with _manifest_fragment_indexes_lock:
+        _manifest_fragment_indexes.clear()
+
+
 def get_mesh_manifests_intersecting_bbox(cv, segids, bbox):
-    filtered_manifests = {}
-    for segid, manifests in cv.mesh._get_manifests(segids).items():
-        filtered_manifests[segid] = [
-            m for m in manifests if bb_included(bbox, bbox_from_filename(m))]      
-    return filtered_manifests
+    return get_manifest_fragment_index(cv).intersecting(cv, segids, bbox)
+
+
+def _volume_key(cv):
+    return getattr(cv, "cloudpath", None) or cv.meta.cloudpath
+
+
+def _download_decode_fragments(cv, fns):
+    decoded = {}
+    for fn, content in cv.mesh._get_mesh_fragments(fns):
+      try:
+        decoded[fn] = Mesh.from_precomputed(content)
+      except Exception:
+        print(fn, 'had a problem.')
+        raise
+    return decoded
+
+
+class GrowableMeshBuffer:
+    """vertices, faces (offset into the buffer's vertices) and normals of
+    appended meshes, stored in arrays grown in place geometrically"""
+    def __init__(self, vertex_capacity=1024, face_capacity=2048,
+                 vertex_dtype=numpy.float32, face_dtype=numpy.uint32):
+        self.n_vertices = 0
+        self.n_faces = 0
+        self.has_normals = True
+        self._vertices = numpy.empty((vertex_capacity, 3), dtype=vertex_dtype)
+        self._normals = numpy.empty((vertex_capacity, 3), dtype=vertex_dtype)
+        self._faces = numpy.empty((face_capacity, 3), dtype=face_dtype)
+
+    @staticmethod
+    def _reserve(arr, n):
+        if n > len(arr):
+            arr.resize((max(n, len(arr) + len(arr) // 2), 3), refcheck=False)
+
+    def append(self, vertices, faces, normals=None):
+        nv, nf = len(vertices), len(faces)
+        self._reserve(self._vertices, self.n_vertices + nv)
+        self._reserve(self._faces, self.n_faces + nf)
+        self._vertices[self.n_vertices:self.n_vertices + nv] = vertices
+        self._faces[self.n_faces:self.n_faces + nf] = faces
+        self._faces[self.n_faces:self.n_faces + nf] += self.n_vertices
+        if normals is None or len(normals) != nv:
+            self.has_normals = self.has_normals and nv == 0
+        elif self.has_normals:
+            self._reserve(self._normals, self.n_vertices + nv)
+            self._normals[self.n_vertices:self.n_vertices + nv] = normals
+        self.n_vertices += nv
+        self.n_faces += nf
+
+    def to_mesh(self):
+        """Mesh of the buffer's arrays, trimmed in place.  The buffer
+        should not be appended to afterwards."""
+        self._vertices.resize((self.n_vertices, 3), refcheck=False)
+        self._faces.resize((self.n_faces, 3), refcheck=False)
+        if self.has_normals:
+            self._normals.resize((self.n_vertices, 3), refcheck=False)
+            normals = self._normals
+        else:
+            normals = numpy.empty((0, 3), dtype=self._vertices.dtype)
+        return Mesh(self._vertices, self._faces, normals)
+
+
+def _fetch_segid_meshes_bbox(cv, segids, bbox, fuse=False, max_workers=8,
+                             fragments_per_request=16, max_in_flight=None):
+    """{ segid: Mesh } of fragments of segids intersecting bbox, with
+    empty meshes for segids without intersecting fragments, or with fuse
+    a single Mesh of all segids in segid order
+
+    fragments are downloaded and decoded in batches on a thread pool with
+    at most max_in_flight batches outstanding, and appended in manifest
+    order to a GrowableMeshBuffer per segid (or one buffer with fuse).
+    """
+    dne = cv.mesh.exists(segids)
+    dne = [ label for label, path in dne.items() if path is None ]
+
+    if dne:
+      missing = ', '.join([ str(segid) for segid in dne ])
+      raise ValueError(red(
+        'Segment ID(s) {} are missing corresponding mesh manifests.\nAborted.' \
+        .format(missing)
+      ))
+
+    fragments = get_mesh_manifests_intersecting_bbox(cv, segids, bbox)
+    fragments = fragments.values()
+    fragments = list(itertools.chain.from_iterable(fragments)) # flatten
+    if fuse:
+      fragments.sort(key=filename_to_segid)
+    batches = [
+      fragments[i:i + fragments_per_request]
+      for i in range(0, len(fragments), fragments_per_request)
+    ]
+    max_in_flight = max_in_flight or 2 * max_workers
+
+    if fuse:
+      fused_buffer = GrowableMeshBuffer()
+      buffers = collections.defaultdict(lambda: fused_buffer)
+    else:
+      buffers = { segid: GrowableMeshBuffer() for segid in segids }
+    with tqdm(total=len(fragments), disable=(not cv.config.progress), desc="Decoding Mesh Buffer") as pbar, \
+        concurrent.futures.ThreadPoolExecutor(max_workers) as e:
+      futs = collections.deque()
+
+      def append_next():
+        batch, fut = futs.popleft()
+        decoded = fut.result()
+        for fn in batch:
+          mesh = decoded.pop(fn)
+          buffers[filename_to_segid(fn)].append(
+            mesh.vertices, mesh.faces, mesh.normals)
+          pbar.update(1)
+
+      for batch in batches:
+        futs.append((batch, e.submit(_download_decode_fragments, cv, batch)))
+        if len(futs) >= max_in_flight:
+          append_next()
+      while futs:
+        append_next()
+
+    if fuse:
+      return fused_buffer.to_mesh()
+    return { segid: buffer.to_mesh() for segid, buffer in buffers.items() }
 
 
 def get_mesh_bbox(
       cv, segids, bbox, 
       remove_duplicate_vertices=True, 
       fuse=True,
-      chunk_size=None):
+      chunk_size=None,
+      mesh_cache=None,
+      max_workers=8):
     """
     Merge fragments derived from these segids into a single vertex and face list.
     Why merge multiple segids into one mesh? For example, if you have a set of
@@ -44,45 +288,76 @@ def get_mesh_bbox(
       remove_duplicate_vertices: bool, fuse exactly matching vertices
       fuse: bool, merge all downloaded meshes into a single mesh
       chunk_size: [chunk_x, chunk_y, chunk_z] if passed only merge at chunk boundaries
+      mesh_cache: MeshCache read through per (volume, segid, bbox, mip),
+        default mesh_cache.get_default_mesh_cache().  False disables caching.
+      max_workers: threads downloading and decoding fragments
     
     Returns: Mesh object if fused, else { segid: Mesh, ... }
     """
-    segids = toiter(segids)
-    dne = cv.mesh.exists(segids)
-    dne = [ label for label, path in dne.items() if path is None ]
-
-    if dne:
-      missing = ', '.join([ str(segid) for segid in dne ])
-      raise ValueError(red(
-        'Segment ID(s) {} are missing corresponding mesh manifests.\nAborted.' \
-        .format(missing)
-      ))
-
-    fragments = get_mesh_manifests_intersecting_bbox(cv, segids, bbox)
-    fragments = fragments.values()
-    fragments = list(itertools.chain.from_iterable(fragments)) # flatten
-    fragments = cv.mesh._get_mesh_fragments(fragments)
-
-    # decode all the fragments
-    meshdata = defaultdict(list)
-    for frag in tqdm(fragments, disable=(not cv.config.progress), desc="Decoding Mesh Buffer"):
-      segid = filename_to_segid(frag[0])
-      try:
-        mesh = Mesh.from_precomputed(frag[1])
-      except Exception:
-        print(frag[0], 'had a problem.')
-        raise
-      meshdata[segid].append(mesh)
+    segids = [ int(segid) for segid in toiter(segids) ]
+    if mesh_cache is None:
+      mesh_cache = get_default_mesh_cache()
+    elif mesh_cache is False:
+      mesh_cache = None
+
+    if fuse and mesh_cache is None:
+      # stream all segids into one buffer rather than concatenating
+      mesh = _fetch_segid_meshes_bbox(
+        cv, segids, bbox, fuse=True, max_workers=max_workers)
+      if not len(mesh.vertices):
+        _raise_no_fragments_bbox(segids, bbox)
+      return _finish_fused_mesh_bbox(
+        cv, mesh, remove_duplicate_vertices, chunk_size)
+
+    segid_meshes = {}
+    if mesh_cache is not None:
+      volume = _volume_key(cv)
+      segid_keys = {
+        segid: mesh_cache.key(volume, segid, bbox, cv.mip) for segid in segids
+      }
+      for segid, key in segid_keys.items():
+        arrays = mesh_cache.get(key)
+        if arrays is not None:
+          segid_meshes[segid] = Mesh(
+            arrays["vertices"], arrays["faces"], arrays["normals"])
+
+    missing_segids = [ segid for segid in segids if segid not in segid_meshes ]
+    if missing_segids:
+      fetched = _fetch_segid_meshes_bbox(
+        cv, missing_segids, bbox, max_workers=max_workers)
+      segid_meshes.update(fetched)
+      if mesh_cache is not None:
+        for segid, mesh in fetched.items():
+          mesh_cache.put(
+            segid_keys[segid], mesh.vertices, mesh.faces, mesh.normals)
+
+    # segids without fragments in bbox are left out, as when decoding
+    meshdata = {
+      segid: mesh for segid, mesh in segid_meshes.items() if len(mesh.vertices)
+    }
 
     if not fuse:
-      return { segid: Mesh.concatenate(*meshes) for segid, meshes in six.iteritems(meshdata) }
+      return meshdata
 
-    meshdata = [ (segid, mesh) for segid, mesh in six.iteritems(meshdata) ]
+    meshdata = [ (segid, mesh) for segid, mesh in meshdata.items() ]
     meshdata = sorted(meshdata, key=lambda sm: sm[0])
     meshdata = [ mesh for segid, mesh in meshdata ]
-    meshdata = list(itertools.chain.from_iterable(meshdata)) # flatten
-    mesh = Mesh.concatenate(*meshdata)
+    if not meshdata:
+      _raise_no_fragments_bbox(segids, bbox)
+    # a single segid's buffer is already contiguous
+    mesh = meshdata[0] if len(meshdata) == 1 else Mesh.concatenate(*meshdata)
+    return _finish_fused_mesh_bbox(
+      cv, mesh, remove_duplicate_vertices, chunk_size)
+
+
+def _raise_no_fragments_bbox(segids, bbox):
+    # as Mesh.concatenate of no fragments, cached or not
+    raise ValueError(
+      'No mesh fragments of segment ID(s) {} intersect {}.'.format(
+        ', '.join(str(segid) for segid in segids), bbox))
 
+
+def _finish_fused_mesh_bbox(cv, mesh, remove_duplicate_vertices, chunk_size):
     if not remove_duplicate_vertices:
       return mesh 
 
@@ -219,52 +494,227 @@ def get_mesh_bbox(
 #     )
 
 
-def yield_cilobj_segids(cv, cilobj,
-                        points_to_consider=[
-                            "base_pix",
-                            "exit_pix"
-                            "soma_valence_pt_pix",
-                            "tip_pix"],
-                        pt_scale=None):
-    previous_seg_ids = []
-    for attr in points_to_consider:
-        pt = getattr(cilobj, attr, None)
-        if pt is None:
-            continue
-        try:
-            if pt_scale is None:
-                scaled_pt = cv.point_to_mip(pt, 0, cv.mip)
-            else:
-                scaled_pt = numpy.array(pt_scale) * numpy.array(pt)
-            seg_id = cv[scaled_pt.tolist()].flatten()[0]
-        except Exception as e:  # TODO better cv obj
-            print(e)
-            continue
-        if seg_id:
-            if seg_id not in previous_seg_ids:
-                yield seg_id
-                previous_seg_ids.append(seg_id)
-
-
-def yield_skelcd_segids(cv, skelcd, pt_scale=None, sample_rate=1):
-    previous_seg_ids = []
-    for swc_vtx in skelcd[0][::sample_rate]:
-        pt = numpy.array(swc_vtx[3:6])
-        if pt is None:
-            continue
+def points_to_voxels(cv, pts, pt_scale=None):
+    """voxel indices at cv.mip of Nx3 points, as indexed by cv[pt] of
+    cv.point_to_mip(pt, 0, cv.mip) or of pt_scale * pt"""
+    pts = numpy.asarray(pts, dtype=float).reshape(-1, 3)
+    if pt_scale is None:
+        downsample_ratio = (
+            cv.meta.resolution(0).astype(numpy.float32) /
+            cv.meta.resolution(cv.mip).astype(numpy.float32))
+        scaled_pts = numpy.floor(pts * downsample_ratio)
+    else:
+        scaled_pts = numpy.array(pt_scale) * pts
+    # cloudvolume indexes with int(), truncating toward zero
+    return numpy.trunc(scaled_pts).astype(numpy.int64)
+
+
+def _download_chunk(cv, chunk_bbox):
+    return numpy.asarray(cv[chunk_bbox.to_slices()])[..., 0]
+
+
+class SegmentationChunkCache:
+    """thread-safe in-memory LRU cache of downloaded segmentation chunks
+    keyed by (volume, mip, chunk index), holding at most max_bytes of
+    chunk arrays"""
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._chunks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                chunk = self._chunks[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._chunks.move_to_end(key)
+            self.hits += 1
+            return chunk
+
+    def put(self, key, chunk):
+        if chunk.nbytes > self.max_bytes:
+            return
+        chunk.flags.writeable = False
+        with self._lock:
+            old = self._chunks.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._chunks[key] = chunk
+            self.nbytes += chunk.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def get_or_download(self, cv, chunk_idx, chunk_bbox):
+        key = (_volume_key(cv), cv.mip, tuple(int(i) for i in chunk_idx))
+        chunk = self.get(key)
+        if chunk is None:
+            chunk = _download_chunk(cv, chunk_bbox)
+            self.put(key, chunk)
+        return chunk
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.nbytes = 0
+
+    def __repr__(self):
+        return ("SegmentationChunkCache({} chunks, {}/{} bytes, "
+                "{} hits, {} misses)").format(
+                    len(self), self.nbytes, self.max_bytes,
+                    self.hits, self.misses)
+
+
+_default_chunk_cache = SegmentationChunkCache()
+
+
+def set_default_chunk_cache(cache=None, **kwargs):
+    """set the chunk cache used by segid lookups when none is passed: a
+    SegmentationChunkCache, None for a new one with kwargs (e.g.
+    max_bytes), or False to disable caching"""
+    global _default_chunk_cache
+    if cache is None:
+        cache = SegmentationChunkCache(**kwargs)
+    _default_chunk_cache = None if cache is False else cache
+    return _default_chunk_cache
+
+
+def get_default_chunk_cache():
+    return _default_chunk_cache
+
+
+def lookup_point_segids(cv, pts, pt_scale=None, max_workers=8,
+                        chunk_cache=None):
+    """segmentation id at each of N points, 0 outside the volume or where
+    the chunk could not be downloaded
+
+    points are grouped by storage chunk of cv at cv.mip so each chunk is
+    downloaded once, with up to max_workers downloads in flight.  Chunks
+    are read through chunk_cache (default get_default_chunk_cache(),
+    False to disable).
+    """
+    if chunk_cache is None:
+        chunk_cache = get_default_chunk_cache()
+    elif chunk_cache is False:
+        chunk_cache = None
+    voxels = points_to_voxels(cv, pts, pt_scale=pt_scale)
+    segids = numpy.zeros(len(voxels), dtype=numpy.uint64)
+    bounds = cv.bounds
+    in_bounds = numpy.flatnonzero(
+        ((voxels >= numpy.asarray(bounds.minpt)) &
+         (voxels < numpy.asarray(bounds.maxpt))).all(axis=1))
+    if not len(in_bounds):
+        return segids
+
+    chunk_size = numpy.asarray(cv.chunk_size)
+    voxel_offset = numpy.asarray(cv.voxel_offset)
+    chunk_idxs = (voxels[in_bounds] - voxel_offset) // chunk_size
+    chunks, pt_chunks = numpy.unique(chunk_idxs, axis=0, return_inverse=True)
+    pt_chunks = pt_chunks.reshape(-1)
+    order = numpy.argsort(pt_chunks, kind="stable")
+    chunk_starts = numpy.searchsorted(pt_chunks[order], numpy.arange(len(chunks) + 1))
+
+    def chunk_bbox(chunk):
+        minpt = voxel_offset + chunk * chunk_size
+        return cloudvolume.Bbox(
+            minpt, numpy.minimum(minpt + chunk_size, bounds.maxpt))
+
+    def lookup_chunk(i):
+        bbox = chunk_bbox(chunks[i])
+        pt_idxs = in_bounds[order[chunk_starts[i]:chunk_starts[i + 1]]]
         try:
-            if pt_scale is None:
-                scaled_pt = cv.point_to_mip(pt, 0, cv.mip)
+            if chunk_cache is None:
+                chunk = _download_chunk(cv, bbox)
             else:
-                scaled_pt = numpy.array(pt_scale) * numpy.array(pt)
-            seg_id = cv[scaled_pt.tolist()].flatten()[0]
+                chunk = chunk_cache.get_or_download(cv, chunks[i], bbox)
         except Exception as e:  # TODO better cv obj
             print(e)
-            continue
-        if seg_id:
-            if seg_id not in previous_seg_ids:
-                yield seg_id
-                previous_seg_ids.append(seg_id)
+            return
+        local = voxels[pt_idxs] - numpy.asarray(bbox.minpt)
+        segids[pt_idxs] = chunk[local[:, 0], local[:, 1], local[:, 2]]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as e:
+        for _ in e.map(lookup_chunk, range(len(chunks))):
+            pass
+    return segids
+
+
+def _unique_nonzero(segids):
+    seen = set()
+    for seg_id in segids.tolist():
+        if seg_id and seg_id not in seen:
+            seen.add(seg_id)
+            yield seg_id
+
+
+def _lookup_grouped_segids(cv, pt_groups, **kwargs):
+    """per group of points, unique nonzero segids in point order, from one
+    batched lookup over all groups"""
+    pt_groups = [numpy.asarray(pts, dtype=float).reshape(-1, 3)
+                 for pts in pt_groups]
+    if not pt_groups:
+        return []
+    segids = lookup_point_segids(cv, numpy.concatenate(pt_groups), **kwargs)
+    group_segids = numpy.split(
+        segids, numpy.cumsum([len(pts) for pts in pt_groups])[:-1])
+    return [list(_unique_nonzero(s)) for s in group_segids]
+
+
+default_cilobj_segid_points = [
+    "base_pix",
+    "exit_pix",
+    "soma_valence_pt_pix",
+    "tip_pix"]
+
+
+def _cilobj_pts(cilobj, points_to_consider):
+    return [pt for pt in (getattr(cilobj, attr, None)
+                          for attr in points_to_consider)
+            if pt is not None]
+
+
+def get_cilobjs_segids(cv, cilobjs,
+                       points_to_consider=default_cilobj_segid_points,
+                       pt_scale=None, max_workers=8, chunk_cache=None):
+    """unique segids at annotation points of each cilobj, from one
+    chunk-grouped lookup"""
+    return _lookup_grouped_segids(
+        cv, [_cilobj_pts(cilobj, points_to_consider) for cilobj in cilobjs],
+        pt_scale=pt_scale, max_workers=max_workers, chunk_cache=chunk_cache)
+
+
+def get_skelcds_segids(cv, skelcds, pt_scale=None, sample_rate=1,
+                       max_workers=8, chunk_cache=None):
+    """unique segids at (sampled) vertices of each skeleton, from one
+    chunk-grouped lookup"""
+    return _lookup_grouped_segids(
+        cv, [skeleton_vertices(skelcd)[::sample_rate] for skelcd in skelcds],
+        pt_scale=pt_scale, max_workers=max_workers, chunk_cache=chunk_cache)
+
+
+def yield_cilobj_segids(cv, cilobj,
+                        points_to_consider=default_cilobj_segid_points,
+                        pt_scale=None, chunk_cache=None):
+    yield from get_cilobjs_segids(
+        cv, [cilobj], points_to_consider=points_to_consider,
+        pt_scale=pt_scale, chunk_cache=chunk_cache)[0]
+
+
+def yield_skelcd_segids(cv, skelcd, pt_scale=None, sample_rate=1,
+                        chunk_cache=None):
+    yield from get_skelcds_segids(
+        cv, [skelcd], pt_scale=pt_scale, sample_rate=sample_rate,
+        chunk_cache=chunk_cache)[0]
 
 
 def get_skelcd_segids(*args, **kwargs):
@@ -295,29 +745,157 @@ def cilium_bbox_pix(cilobj, buffer=(0, 0, 0)):
     return get_buffered_bbox(cilbbox, buffer=buffer)
 
 
+def iter_segid_to_bboxmesh_maps(
+        mesh_cv, jobs, max_workers=8, fragments_per_request=32,
+        mesh_cache=None, raise_errors=False):
+    """yield (cellname, { segid: Mesh }) for (cellname, segids, bbox) jobs
+    as the fragments of each cell finish downloading
+
+    manifests are fetched once for all segids and each fragment is
+    downloaded and decoded once, in batches on a thread pool, however many
+    cells share it.  Meshes are read through mesh_cache as in
+    get_mesh_bbox.  Segids without a manifest or fragments in the bbox
+    are left out, and cells with failed downloads yield None, unless
+    raise_errors, where missing manifests and segids without fragments in
+    the bbox raise ValueError (as get_mesh_bbox) and failed downloads
+    re-raise.
+    """
+    if mesh_cache is None:
+        mesh_cache = get_default_mesh_cache()
+    elif mesh_cache is False:
+        mesh_cache = None
+    volume = _volume_key(mesh_cv)
+    jobs = [(cn, list(toiter(segids)), bbox) for cn, segids, bbox in jobs]
+
+    # cached meshes, and segids to fetch per cell
+    cell_meshes, cell_uncached = [], []
+    for cn, segids, bbox in jobs:
+        meshes, uncached = {}, []
+        for segid in map(int, segids):
+            arrays = (None if mesh_cache is None else mesh_cache.get(
+                mesh_cache.key(volume, segid, bbox, mesh_cv.mip)))
+            if arrays is None:
+                uncached.append(segid)
+            elif len(arrays["vertices"]):
+                meshes[segid] = Mesh(
+                    arrays["vertices"], arrays["faces"], arrays["normals"])
+        cell_meshes.append(meshes)
+        cell_uncached.append(uncached)
+
+    fetch_segids = sorted(set(itertools.chain.from_iterable(cell_uncached)))
+    dne = set()
+    if fetch_segids:
+        dne = {label for label, path in mesh_cv.mesh.exists(fetch_segids).items()
+               if path is None}
+        if dne and raise_errors:
+            raise ValueError(red(
+                'Segment ID(s) {} are missing corresponding mesh manifests.\nAborted.'
+                .format(', '.join(str(segid) for segid in sorted(dne)))))
+        if dne:
+            print("Segment ID(s) {} are missing corresponding mesh manifests.".format(
+                ', '.join(str(segid) for segid in sorted(dne))))
+    index = get_manifest_fragment_index(mesh_cv)
+    segid_fragments = index.fetch(
+        mesh_cv, [segid for segid in fetch_segids if segid not in dne])
+    cell_fragments = [
+        _fragments_intersecting(segid_fragments, uncached, bbox)
+        for uncached, (_, _, bbox) in zip(cell_uncached, jobs)]
+
+    # cells waiting on each fragment, in job order
+    fragment_cells = collections.defaultdict(list)
+    for i, segid_fns in enumerate(cell_fragments):
+        for fn in itertools.chain.from_iterable(segid_fns.values()):
+            fragment_cells[fn].append(i)
+    pending = [
+        set(itertools.chain.from_iterable(segid_fns.values()))
+        for segid_fns in cell_fragments]
+    decoded = {}
+    failed = set()
+
+    def finish(i):
+        cn, segids, bbox = jobs[i]
+        meshes = cell_meshes[i]
+        for segid, fns in cell_fragments[i].items():
+            if i in failed:
+                break
+            if fns:
+                meshes[segid] = Mesh.concatenate(*[decoded[fn] for fn in fns])
+            if mesh_cache is not None:
+                mesh = meshes.get(segid)
+                mesh_cache.put(
+                    mesh_cache.key(volume, segid, bbox, mesh_cv.mip),
+                    *((mesh.vertices, mesh.faces, mesh.normals)
+                      if mesh is not None
+                      else (numpy.empty((0, 3), dtype=numpy.float32),
+                            numpy.empty((0, 3), dtype=numpy.uint32))))
+        for fn in set(itertools.chain.from_iterable(
+                cell_fragments[i].values())):
+            fragment_cells[fn].remove(i)
+            if not fragment_cells[fn]:
+                del fragment_cells[fn]
+                decoded.pop(fn, None)
+        cell_meshes[i] = cell_fragments[i] = None
+        if i in failed:
+            return cn, None
+        if raise_errors:
+            empty = [segid for segid in segids if int(segid) not in meshes]
+            if empty:
+                _raise_no_fragments_bbox(empty, bbox)
+        return cn, {segid: meshes[int(segid)] for segid in segids
+                    if int(segid) in meshes}
+
+    for i in range(len(jobs)):
+        if not pending[i]:
+            yield finish(i)
+
+    fns = list(fragment_cells)
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as e:
+        futs = {
+            e.submit(_download_decode_fragments, mesh_cv, batch): batch
+            for batch in (fns[j:j + fragments_per_request]
+                          for j in range(0, len(fns), fragments_per_request))}
+        for fut in concurrent.futures.as_completed(futs):
+            batch = futs.pop(fut)
+            try:
+                decoded.update(fut.result())
+            except Exception as ex:  # TODO better cv obj
+                if raise_errors:
+                    for other in futs:
+                        other.cancel()
+                    raise
+                print(ex)
+                failed.update(
+                    itertools.chain.from_iterable(
+                        fragment_cells[fn] for fn in batch))
+            for fn in batch:
+                for i in list(fragment_cells.get(fn, ())):
+                    pending[i].discard(fn)
+                    if not pending[i]:
+                        yield finish(i)
+
+
+def get_segid_to_bboxmesh_maps(mesh_cv, jobs, **kwargs):
+    """{ cellname: { segid: Mesh } } for (cellname, segids, bbox) jobs, see
+    iter_segid_to_bboxmesh_maps"""
+    return dict(iter_segid_to_bboxmesh_maps(mesh_cv, jobs, **kwargs))
+
+
 def get_segid_to_bboxmesh_map_from_cilobj_buffer(
-        mesh_cv, segids, cilobj, bbox_buffer=[100, 100, 10]):
-    segid_to_bboxmesh = {}
+        mesh_cv, segids, cilobj, bbox_buffer=[100, 100, 10], **kwargs):
     cbbox = cilium_bbox_pix(cilobj, bbox_buffer)
-    for segid in segids:
-        bboxmesh = get_mesh_bbox(
-            mesh_cv, [segid], cbbox, remove_duplicate_vertices=False)
-        segid_to_bboxmesh[segid] = bboxmesh
-    return segid_to_bboxmesh
+    return get_segid_to_bboxmesh_map_from_bbox(
+        mesh_cv, segids, cbbox, **kwargs)
 
 
 def get_segid_to_bboxmesh_map_from_bbox(
-        mesh_cv, segids, bbox):
-    segid_to_bboxmesh = {}
-    for segid in segids:
-        bboxmesh = get_mesh_bbox(
-            mesh_cv, [segid], bbox, remove_duplicate_vertices=False)
-        segid_to_bboxmesh[segid] = bboxmesh
+        mesh_cv, segids, bbox, **kwargs):
+    (_, segid_to_bboxmesh), = iter_segid_to_bboxmesh_maps(
+        mesh_cv, [(None, segids, bbox)], raise_errors=True, **kwargs)
     return segid_to_bboxmesh
 
 
 def get_skelcd_bbox(cdskel):
-    vtxs, _, _ = vtxs_edges_rootid_read_compact_detail(cdskel)
+    vtxs = skeleton_vertices(cdskel)
     vtxmin = numpy.min(vtxs, axis=0)
     vtxmax = numpy.max(vtxs, axis=0)
     return cloudvolume.Bbox.from_points([
@@ -0,0 +1,149 @@
+"""
+persistent on-disk cache of bbox-cropped meshes
+
+entries are keyed by (volume, segid, bbox, mip) and stored as uncompressed
+.npz files of vertices, faces and normals under a content hash of the
+key.  File modification times record last use, and the least recently
+used entries are evicted once the cache exceeds max_bytes.
+"""
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+import numpy
+
+ENTRY_SUFFIX = ".npz"
+
+
+class MeshCache:
+    """least recently used on-disk cache of mesh arrays
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        cache directory, created if needed
+    max_bytes : int
+        size of entries above which least recently used entries are
+        evicted
+    """
+    def __init__(self, path, max_bytes=10 * 2 ** 30):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = sum(size for _, _, size in self._entry_stats())
+
+    @staticmethod
+    def key(volume, segid, bbox, mip):
+        """hex digest of (volume, segid, bbox, mip), where bbox is a
+        cloudvolume.Bbox or (minpt, maxpt)"""
+        minpt, maxpt = ((bbox.minpt, bbox.maxpt) if hasattr(bbox, "minpt")
+                        else bbox)
+        key = json.dumps([
+            str(volume), int(segid),
+            numpy.asarray(minpt).tolist(), numpy.asarray(maxpt).tolist(),
+            None if mip is None else int(mip)])
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _entry_path(self, key):
+        return self.path / key[:2] / (key + ENTRY_SUFFIX)
+
+    def _entry_stats(self):
+        for entry_path in self.path.glob("*/*" + ENTRY_SUFFIX):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            yield entry_path, stat.st_mtime, stat.st_size
+
+    def __len__(self):
+        return sum(1 for _ in self._entry_stats())
+
+    def __contains__(self, key):
+        return self._entry_path(key).is_file()
+
+    def get(self, key):
+        """dict of vertices, faces and normals for key or None"""
+        entry_path = self._entry_path(key)
+        try:
+            with numpy.load(entry_path) as npz:
+                arrays = {k: npz[k] for k in npz.files}
+        except (FileNotFoundError, OSError, ValueError, EOFError):
+            # missing, or partially written by an interrupted process
+            self.misses += 1
+            return None
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return arrays
+
+    def put(self, key, vertices, faces, normals=None):
+        entry_path = self._entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {
+            "vertices": numpy.asarray(vertices),
+            "faces": numpy.asarray(faces),
+            "normals": (numpy.empty((0, 3), dtype=numpy.float32)
+                        if normals is None else numpy.asarray(normals))
+        }
+        # write to a temporary file and rename so readers never see a
+        #   partial entry
+        fd, tmp_path = tempfile.mkstemp(
+            dir=entry_path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                numpy.savez(f, **arrays)
+            try:
+                old_size = entry_path.stat().st_size
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            raise
+        self.total_bytes += entry_path.stat().st_size - old_size
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self, max_bytes=None):
+        """remove least recently used entries until the cache is at most
+        max_bytes (default self.max_bytes)"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self._entry_stats(), key=lambda e: e[1])
+        total_bytes = sum(size for _, _, size in entries)
+        for entry_path, _, size in entries:
+            if total_bytes <= max_bytes:
+                break
+            entry_path.unlink(missing_ok=True)
+            total_bytes -= size
+        self.total_bytes = total_bytes
+
+    def clear(self):
+        self.evict(max_bytes=0)
+
+    def __repr__(self):
+        return "MeshCache({}, {}/{} bytes)".format(
+            self.path, self.total_bytes, self.max_bytes)
+
+
+_default_mesh_cache = None
+
+
+def set_default_mesh_cache(cache=None, **kwargs):
+    """set the cache used by cloudvolume_utils.get_mesh_bbox when none is
+    passed: a MeshCache, a directory for one (with MeshCache kwargs), or
+    None to disable caching"""
+    global _default_mesh_cache
+    if cache is not None and not isinstance(cache, MeshCache):
+        cache = MeshCache(cache, **kwargs)
+    _default_mesh_cache = cache
+    return cache
+
+
+def get_default_mesh_cache():
+    return _default_mesh_cache
@@ -1,25 +1,119 @@
+import collections.abc
+import itertools
+
 import numpy
+import scipy.spatial
 
 import meshparty
 import meshparty.mesh_filters
+import meshparty.ray_tracing
+import meshparty.skeleton
+import meshparty.trimesh_io
 import trimesh
 
 from pycilium.utils.skeleton_utils import *
 
 
-def filter_mesh_cdskel_line_distance(mesh, cdskel, radius=600, endcap_buffer=300):
-    segs = skelcd_to_linesegments(cdskel)
+def _line_distance_candidates(vertices, seg_starts, seg_ends, radius,
+                              endcap_buffer, axis):
+    """(vertex, segment) index pairs that may pass filter_close_to_line,
+    from one kd-tree over vertices queried with balls covering each
+    segment's line extended by endcap_buffer along axis"""
+    seg_vecs = seg_ends - seg_starts
+    dax = seg_vecs[:, axis]
+    # segments without extent along axis never pass filter_close_to_line
+    valid_segs = numpy.flatnonzero(dax != 0)
+    lo = numpy.minimum(seg_starts[valid_segs, axis], seg_ends[valid_segs, axis])
+    hi = numpy.maximum(seg_starts[valid_segs, axis], seg_ends[valid_segs, axis])
+    ps_lo = (lo - endcap_buffer - seg_starts[valid_segs, axis]) / dax[valid_segs]
+    ps_hi = (hi + endcap_buffer - seg_starts[valid_segs, axis]) / dax[valid_segs]
+    line_lo = seg_starts[valid_segs] + ps_lo[:, None] * seg_vecs[valid_segs]
+    line_hi = seg_starts[valid_segs] + ps_hi[:, None] * seg_vecs[valid_segs]
+
+    # centers at most radius apart along each extended line; balls of
+    #   radius sqrt(radius**2 + (radius / 2)**2) cover the capsule
+    line_lens = numpy.linalg.norm(line_hi - line_lo, axis=1)
+    n_centers = numpy.ceil(line_lens / radius).astype(int) + 1
+    center_segs = numpy.repeat(numpy.arange(len(valid_segs)), n_centers)
+    center_starts = numpy.cumsum(n_centers) - n_centers
+    t = (numpy.arange(len(center_segs)) - center_starts[center_segs]) / (
+        n_centers[center_segs] - 1)
+    centers = line_lo[center_segs] + t[:, None] * (
+        line_hi - line_lo)[center_segs]
+    ball_radius = radius * numpy.sqrt(1.25) * (1 + 1e-6)
+
+    tree = scipy.spatial.cKDTree(vertices)
+    hits = tree.query_ball_point(centers, ball_radius, return_sorted=False)
+    n_hits = numpy.fromiter(map(len, hits), dtype=int, count=len(hits))
+    vtx_idxs = numpy.fromiter(
+        itertools.chain.from_iterable(hits), dtype=int, count=n_hits.sum())
+    seg_idxs = valid_segs[numpy.repeat(center_segs, n_hits)]
+    pair_keys = numpy.unique(vtx_idxs * len(seg_starts) + seg_idxs)
+    return pair_keys // len(seg_starts), pair_keys % len(seg_starts)
+
+
+def filter_vertices_close_to_segments(vertices, seg_starts, seg_ends, radius,
+                                      endcap_buffer=0, axis=1):
+    """union over segments of meshparty.mesh_filters.filter_close_to_line
+    in a single pass
+
+    Returns
+    -------
+    is_close : numpy.array
+        N boolean mask of vertices close to any segment
+    vertex_seg_idxs : numpy.array
+        N index of the segment with the smallest in-plane distance to each
+        vertex close to a segment, -1 elsewhere
+    """
+    vertices = numpy.asarray(vertices, dtype=float)
+    seg_starts = numpy.asarray(seg_starts, dtype=float).reshape(-1, 3)
+    seg_ends = numpy.asarray(seg_ends, dtype=float).reshape(-1, 3)
+    is_close = numpy.zeros(len(vertices), dtype=bool)
+    vertex_seg_idxs = numpy.full(len(vertices), -1, dtype=int)
+    if not len(vertices) or not len(seg_starts) or not radius > 0:
+        return is_close, vertex_seg_idxs
+
+    vtx_idxs, seg_idxs = _line_distance_candidates(
+        vertices, seg_starts, seg_ends, radius, endcap_buffer, axis)
+
+    # same arithmetic as filter_close_to_line on the candidate pairs
+    pts, a, b = vertices[vtx_idxs], seg_starts[seg_idxs], seg_ends[seg_idxs]
+    ps = (pts[:, axis] - a[:, axis]) / (b[:, axis] - a[:, axis])
+    ds = numpy.linalg.norm(pts - (ps[:, None] * (b - a) + a), axis=1)
+    pair_close = (
+        (ds < radius) &
+        (pts[:, axis] < numpy.maximum(a[:, axis], b[:, axis]) + endcap_buffer) &
+        (pts[:, axis] > numpy.minimum(a[:, axis], b[:, axis]) - endcap_buffer))
+
+    vtx_idxs, seg_idxs, ds = (
+        vtx_idxs[pair_close], seg_idxs[pair_close], ds[pair_close])
+    # closest segment is the first pair of each vertex by distance
+    order = numpy.lexsort((ds, vtx_idxs))
+    close_vtx_idxs, first = numpy.unique(vtx_idxs[order], return_index=True)
+    is_close[close_vtx_idxs] = True
+    vertex_seg_idxs[close_vtx_idxs] = seg_idxs[order][first]
+    return is_close, vertex_seg_idxs
+
+
+def filter_mesh_cdskel_line_distance(mesh, cdskel, radius=600, endcap_buffer=300,
+                                     return_segment_idxs=False):
+    """mesh of vertices within radius of any skeleton edge (see
+    filter_vertices_close_to_segments).  With return_segment_idxs also
+    returns the skeleton edge index of each vertex of the filtered mesh."""
+    vtxs, edges, _ = skeleton_vtxs_edges_rootid(cdskel)
+    vtxs = numpy.asarray(vtxs, dtype=float)
+    edges = numpy.asarray(edges, dtype=int).reshape(-1, 2)
 
     orig_mesh = meshparty.trimesh_io.Mesh(
         mesh.vertices, mesh.faces, process=False)
-    line_mf = numpy.zeros(orig_mesh.vertices.shape[0], dtype=bool)
-    for seg in segs:
-        line_mf |= meshparty.mesh_filters.filter_close_to_line(
-            orig_mesh, numpy.array(seg), radius,
-            endcap_buffer=endcap_buffer)
+    line_mf, vertex_seg_idxs = filter_vertices_close_to_segments(
+        orig_mesh.vertices, vtxs[edges[:, 0]], vtxs[edges[:, 1]], radius,
+        endcap_buffer=endcap_buffer)
     line_mesh = meshparty.trimesh_io.Mesh(
         vertices=orig_mesh.vertices, node_mask=line_mf,
         faces=orig_mesh.faces, apply_mask=True, process=False)
+    if return_segment_idxs:
+        return line_mesh, vertex_seg_idxs[line_mf]
     return line_mesh
 
 
@@ -36,37 +130,77 @@ def filter_meshes_cdskel_line_distance(*args, **kwargs):
     return [*gen_filter_meshes_cdskel_line_distance(*args, **kwargs)]
 
 
+class MultiMeshProximity:
+    """closest points on a set of meshes from one combined trimesh with the
+    source mesh of each triangle, so repeated queries (e.g. for several
+    skeletons of a cell) reuse its triangle tree and ray intersectors"""
+    def __init__(self, meshes):
+        if isinstance(meshes, collections.abc.Mapping):
+            meshes = meshes.values()
+        self.meshes = list(meshes)
+        n_vertices = [len(mesh.vertices) for mesh in self.meshes]
+        n_faces = [len(mesh.faces) for mesh in self.meshes]
+        # IndexError as for meshes with no vertices left after filtering
+        #   (see mpskel_with_radius_from_skelcd_meshes_or_None)
+        if not sum(n_faces):
+            raise IndexError("no mesh faces to query")
+        vertex_offsets = numpy.cumsum([0] + n_vertices[:-1])
+        self.face_offsets = numpy.cumsum([0] + n_faces)
+        self.face_mesh_idxs = numpy.repeat(
+            numpy.arange(len(self.meshes)), n_faces)
+        self.combined_mesh = trimesh.Trimesh(
+            numpy.concatenate([mesh.vertices for mesh in self.meshes]),
+            numpy.concatenate([
+                numpy.asarray(mesh.faces) + offset
+                for mesh, offset in zip(self.meshes, vertex_offsets)]),
+            process=False)
+        self._ray_intersectors = {}
+
+    def closest_point(self, pts):
+        """closest points, distances, mesh index and triangle index within
+        that mesh for each point"""
+        closest, distance, triangle = trimesh.proximity.closest_point(
+            self.combined_mesh, numpy.asarray(pts, dtype=float))
+        mesh_idxs = self.face_mesh_idxs[triangle]
+        return (closest, distance, mesh_idxs,
+                triangle - self.face_offsets[mesh_idxs])
+
+    def ray_intersector(self, mesh_idx):
+        try:
+            return self._ray_intersectors[mesh_idx]
+        except KeyError:
+            ray_inter = self._ray_intersectors[mesh_idx] = (
+                meshparty.ray_tracing.ray_pyembree.RayMeshIntersector(
+                    self.meshes[mesh_idx]))
+            return ray_inter
+
+
 def mpskel_with_radius_from_skelcd_meshes(skelcd, meshes):
-    vtxs, edges, root_id = vtxs_edges_rootid_read_compact_detail(skelcd)
-    
-    cp_closest, cp_distance, cp_triangle = None, None, None
-    for i, mesh in enumerate(meshes):
-        if cp_closest is None:
-            cp_closest, cp_distance, cp_triangle = trimesh.proximity.closest_point(mesh, vtxs)
-            mesh_idxs = numpy.array([i] * len(vtxs))
-            continue
-        new_cp_closest, new_cp_distance, new_cp_triangle = trimesh.proximity.closest_point(mesh, vtxs)
+    """meshparty skeleton with radius from ray tracing the mesh closest to
+    each vertex.  meshes can be a MultiMeshProximity to reuse across
+    skeletons."""
+    vtxs, edges, root_id = skeleton_vtxs_edges_rootid(skelcd)
+    proximity = (meshes if isinstance(meshes, MultiMeshProximity)
+                 else MultiMeshProximity(meshes))
 
-        dist_mask = new_cp_distance < cp_distance
+    _, cp_distance, mesh_idxs, cp_triangle = proximity.closest_point(vtxs)
 
-        mesh_idxs[dist_mask] = numpy.array([i] * dist_mask.sum())
-        cp_distance[dist_mask] = new_cp_distance[dist_mask]
-        cp_closest[dist_mask] = new_cp_closest[dist_mask]
-        cp_triangle[dist_mask] = new_cp_triangle[dist_mask]
-  
     rtdist = numpy.empty_like(cp_distance)
-    for i, mesh in enumerate(meshes):
+    for i in numpy.unique(mesh_idxs):
+        mesh = proximity.meshes[i]
         mesh_mask = (mesh_idxs == i)
-   
+
         # get first vertex of each face from closest triangles
         mesh_vtxs_idxs = mesh.faces[cp_triangle[mesh_mask]][:, 0]
-    
+
         rtdist[mesh_mask] = meshparty.ray_tracing.ray_trace_distance(
             mesh_vtxs_idxs,
-            mesh
+            mesh,
+            ray_inter=proximity.ray_intersector(i)
         )
-    
-    mpskel = meshparty.skeleton.Skeleton(vtxs, edges, root_id, rtdist)
+
+    mpskel = meshparty.skeleton.Skeleton(
+        vtxs, numpy.array(edges), root_id, rtdist)
     return mpskel
 
 
@@ -0,0 +1,255 @@
+"""
+packed (CSR) storage of many CATMAID compact-detail skeletons
+
+all skeletons' vertices, parents, radii, treenode ids and tags live in
+shared contiguous arrays with per-cell offsets.  Stores can be saved as
+.npy files and memory mapped, and PackedSkeleton views of one cell can be
+passed to skeleton_utils/mesh_utils functions in place of compact-detail.
+"""
+import collections.abc
+import json
+import pathlib
+
+import numpy
+
+from pycilium.utils.skeleton_utils import treenode_ids_to_idxs
+from pycilium.utils.serialize import CiliaAnalysisJsonEncoder
+
+STORE_FILENAME = "packed_skeletons.json"
+
+
+class PackedSkeleton:
+    """zero-copy view of one skeleton in a PackedSkeletonStore.  parents
+    are vertex indices within the skeleton (-1 for roots)."""
+    __slots__ = (
+        "vertices", "parents", "radius", "treenode_ids", "user_ids",
+        "confidences", "tag_vertices", "tag_labels", "extras")
+
+    def __init__(self, vertices, parents, radius, treenode_ids, user_ids,
+                 confidences, tag_vertices, tag_labels, extras=None):
+        self.vertices = vertices
+        self.parents = parents
+        self.radius = radius
+        self.treenode_ids = treenode_ids
+        self.user_ids = user_ids
+        self.confidences = confidences
+        self.tag_vertices = tag_vertices
+        self.tag_labels = tag_labels
+        self.extras = extras
+
+    def __len__(self):
+        return len(self.vertices)
+
+    @property
+    def edges(self):
+        """[parent, child] vertex indices in child order, as returned by
+        read_compact_detail_arrays"""
+        child_idxs = numpy.flatnonzero(self.parents >= 0)
+        return numpy.stack([self.parents[child_idxs], child_idxs], axis=1)
+
+    @property
+    def root(self):
+        roots = numpy.flatnonzero(self.parents < 0)
+        if not len(roots):
+            raise ValueError("skeleton has no root node")
+        return int(roots[-1])
+
+    @property
+    def tags(self):
+        """tag label to vertex indices"""
+        tags = {}
+        for vtx, label in zip(self.tag_vertices, self.tag_labels):
+            try:
+                tags[label].append(int(vtx))
+            except KeyError:
+                tags[label] = [int(vtx)]
+        return tags
+
+    def vtxs_edges_rootid(self):
+        return self.vertices, self.edges, self.root
+
+    def to_compact_detail(self):
+        is_root = self.parents < 0
+        parent_ids = numpy.where(
+            is_root, -1, self.treenode_ids[numpy.maximum(self.parents, 0)])
+        radius = numpy.nan_to_num(self.radius, nan=-1.0)
+        nodes = [
+            [tn, (None if root else pid), uid, x, y, z, r, c]
+            for tn, pid, root, uid, (x, y, z), r, c in zip(
+                self.treenode_ids.tolist(), parent_ids.tolist(),
+                is_root.tolist(), self.user_ids.tolist(),
+                self.vertices.tolist(), radius.tolist(),
+                self.confidences.tolist())]
+        tags = {
+            label: self.treenode_ids[idxs].tolist()
+            for label, idxs in self.tags.items()}
+        extras = [[], []] if self.extras is None else self.extras
+        return [nodes, [], tags, *extras]
+
+    def __repr__(self):
+        return "PackedSkeleton({} vertices)".format(len(self))
+
+
+def skeleton_vertices(skel):
+    """Nx3 vertex coordinates of a PackedSkeleton (or other object with
+    vertices), a (vtxs, edges, root) tuple or a compact-detail skeleton,
+    without parsing its topology"""
+    vertices = getattr(skel, "vertices", None)
+    if vertices is not None:
+        return numpy.asarray(vertices)
+    if len(skel) == 3 and isinstance(skel[0], numpy.ndarray):
+        return skel[0]
+    return numpy.array(
+        [node[3:6] for node in skel[0]], dtype=float).reshape(-1, 3)
+
+
+class PackedSkeletonStore(collections.abc.Mapping):
+    """cellname to PackedSkeleton over shared CSR arrays
+
+    vertex arrays (vertices, parents, radius, treenode_ids, user_ids,
+    confidences) are sliced by vertex_offsets and tag arrays
+    (tag_vertices, tag_label_idxs) by tag_offsets.  Cellnames with no
+    skeleton (None) map to None.
+    """
+    vertex_fields = (
+        "vertices", "parents", "radius", "treenode_ids", "user_ids",
+        "confidences")
+    tag_fields = ("tag_vertices", "tag_label_idxs")
+    offset_fields = ("vertex_offsets", "tag_offsets")
+
+    def __init__(self, cellnames, arrays, tag_labels, extras=None,
+                 present=None, path=None):
+        self.cellnames = list(cellnames)
+        self.arrays = arrays
+        self.tag_labels = list(tag_labels)
+        self.extras = (
+            [None] * len(self.cellnames) if extras is None else extras)
+        self.present = (
+            [True] * len(self.cellnames) if present is None else present)
+        self.path = path
+        self._cn_to_idx = {cn: i for i, cn in enumerate(self.cellnames)}
+
+    @property
+    def resident(self):
+        return self.path is None
+
+    @classmethod
+    def from_skelcds(cls, cn_to_skelcd):
+        """pack a mapping of cellname to compact-detail skeleton (or None)"""
+        cellnames, extras, present = [], [], []
+        label_to_idx = {}
+        vertex_parts = {k: [] for k in cls.vertex_fields}
+        tag_parts = {k: [] for k in cls.tag_fields}
+        vertex_counts, tag_counts = [], []
+
+        for cn, skelcd in cn_to_skelcd.items():
+            cellnames.append(cn)
+            present.append(skelcd is not None)
+            if skelcd is None:
+                extras.append(None)
+                vertex_counts.append(0)
+                tag_counts.append(0)
+                continue
+            nodes, conns, tags, something, annos = skelcd
+            if conns:
+                raise NotImplementedError("Connectors are not supported!")
+            extras.append([something, annos])
+
+            node_arr = numpy.array(nodes, dtype=object).reshape(-1, 8)
+            treenode_ids = node_arr[:, 0].astype(numpy.int64)
+            is_root = numpy.equal(node_arr[:, 1], None)
+            parents = numpy.full(len(nodes), -1, dtype=numpy.int64)
+            parents[~is_root] = treenode_ids_to_idxs(
+                treenode_ids, node_arr[~is_root, 1].astype(numpy.int64))
+            radius = node_arr[:, 6].astype(float)
+            radius[radius < 0] = numpy.nan
+
+            vertex_parts["vertices"].append(node_arr[:, 3:6].astype(float))
+            vertex_parts["parents"].append(parents)
+            vertex_parts["radius"].append(radius)
+            vertex_parts["treenode_ids"].append(treenode_ids)
+            vertex_parts["user_ids"].append(
+                numpy.array([-1 if u is None else u for u in node_arr[:, 2]],
+                            dtype=numpy.int64))
+            vertex_parts["confidences"].append(
+                numpy.array([-1 if c is None else c for c in node_arr[:, 7]],
+                            dtype=numpy.int64))
+            vertex_counts.append(len(nodes))
+
+            n_tags = 0
+            for label, label_treenodes in (tags or {}).items():
+                label_idx = label_to_idx.setdefault(label, len(label_to_idx))
+                tag_vtxs = treenode_ids_to_idxs(treenode_ids, label_treenodes)
+                tag_parts["tag_vertices"].append(tag_vtxs)
+                tag_parts["tag_label_idxs"].append(
+                    numpy.full(len(tag_vtxs), label_idx, dtype=numpy.int64))
+                n_tags += len(tag_vtxs)
+            tag_counts.append(n_tags)
+
+        empty_shapes = {"vertices": (0, 3)}
+        arrays = {
+            k: (numpy.concatenate(parts) if parts
+                else numpy.empty(empty_shapes.get(k, (0,))))
+            for k, parts in {**vertex_parts, **tag_parts}.items()}
+        arrays["vertex_offsets"] = numpy.cumsum(
+            [0] + vertex_counts, dtype=numpy.int64)
+        arrays["tag_offsets"] = numpy.cumsum(
+            [0] + tag_counts, dtype=numpy.int64)
+        return cls(cellnames, arrays, label_to_idx.keys(), extras, present)
+
+    def save(self, path):
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for k, arr in self.arrays.items():
+            numpy.save(path / "{}.npy".format(k), arr)
+        with (path / STORE_FILENAME).open("w") as f:
+            json.dump({
+                "cellnames": self.cellnames,
+                "tag_labels": self.tag_labels,
+                "extras": self.extras,
+                "present": self.present
+            }, f, cls=CiliaAnalysisJsonEncoder)
+        return self
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        path = pathlib.Path(path)
+        with (path / STORE_FILENAME).open("r") as f:
+            store_d = json.load(f)
+        arrays = {
+            k: numpy.load(path / "{}.npy".format(k), mmap_mode=mmap_mode)
+            for k in cls.vertex_fields + cls.tag_fields + cls.offset_fields}
+        cellnames = [tuple(cn) if isinstance(cn, list) else cn
+                     for cn in store_d["cellnames"]]
+        return cls(cellnames, arrays, store_d["tag_labels"],
+                   store_d["extras"], store_d["present"],
+                   path=(None if mmap_mode is None else path))
+
+    def __getitem__(self, cellname):
+        i = self._cn_to_idx[cellname]
+        if not self.present[i]:
+            return None
+        vs, ve = self.arrays["vertex_offsets"][i:i + 2]
+        ts, te = self.arrays["tag_offsets"][i:i + 2]
+        return PackedSkeleton(
+            *(self.arrays[k][vs:ve] for k in self.vertex_fields),
+            self.arrays["tag_vertices"][ts:te],
+            [self.tag_labels[j]
+             for j in self.arrays["tag_label_idxs"][ts:te]],
+            extras=self.extras[i])
+
+    def __iter__(self):
+        return iter(self.cellnames)
+
+    def __len__(self):
+        return len(self.cellnames)
+
+    def __contains__(self, cellname):
+        return cellname in self._cn_to_idx
+
+    def keys(self):
+        return self._cn_to_idx.keys()
+
+    def __repr__(self):
+        return "PackedSkeletonStore({} skeletons, {} vertices)".format(
+            len(self), len(self.arrays["vertices"]))
@@ -0,0 +1,244 @@
+"""
+parallel, resumable estimation of skeleton radii from bbox meshes
+
+each cell's skeleton and meshes go to a process pool (mesh arrays through
+shared memory), and each finished cell is checkpointed to disk with its
+timing, so an interrupted job resumes with the remaining cells.
+"""
+import collections
+import collections.abc
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing.shared_memory
+import os
+import pathlib
+import pickle
+import time
+import traceback
+
+import numpy
+
+import meshparty.trimesh_io
+
+from pycilium.utils.mesh_utils import mpskel_with_radius_from_skelcd_meshes
+from pycilium.utils.serialize import CiliaAnalysisJsonEncoder
+from pycilium.utils.skeleton_utils import skeleton_vtxs_edges_rootid
+
+REPORT_FILENAME = "report.jsonl"
+CELLS_DIRNAME = "cells"
+
+
+def _cell_filename(cellname):
+    key = json.dumps(cellname, cls=CiliaAnalysisJsonEncoder)
+    return "{}.pkl".format(hashlib.sha1(key.encode()).hexdigest())
+
+
+def _mesh_list(meshes):
+    if isinstance(meshes, collections.abc.Mapping):
+        return list(meshes.values())
+    if hasattr(meshes, "vertices"):
+        return [meshes]
+    return list(meshes)
+
+
+def _meshes_to_shared_memory(meshes):
+    """copy vertices (float64) and faces (int64) of meshes into one shared
+    memory block.  Returns the block and the worker's description of it."""
+    vertices = [numpy.asarray(m.vertices, dtype=numpy.float64) for m in meshes]
+    faces = [numpy.asarray(m.faces, dtype=numpy.int64) for m in meshes]
+    n_vertices = [len(v) for v in vertices]
+    n_faces = [len(f) for f in faces]
+    vertices_nbytes = 3 * 8 * sum(n_vertices)
+    shm = multiprocessing.shared_memory.SharedMemory(
+        create=True, size=max(1, vertices_nbytes + 3 * 8 * sum(n_faces)))
+    shm_vertices, shm_faces = _shared_mesh_arrays(
+        shm, n_vertices, n_faces)
+    if vertices:
+        numpy.concatenate(vertices, out=shm_vertices)
+        numpy.concatenate(faces, out=shm_faces)
+    del shm_vertices, shm_faces
+    return shm, (shm.name, n_vertices, n_faces)
+
+
+def _shared_mesh_arrays(shm, n_vertices, n_faces):
+    total_vertices, total_faces = sum(n_vertices), sum(n_faces)
+    shm_vertices = numpy.ndarray(
+        (total_vertices, 3), dtype=numpy.float64, buffer=shm.buf)
+    shm_faces = numpy.ndarray(
+        (total_faces, 3), dtype=numpy.int64, buffer=shm.buf,
+        offset=3 * 8 * total_vertices)
+    return shm_vertices, shm_faces
+
+
+def _meshes_from_shared_memory(shm_name, n_vertices, n_faces):
+    if not n_vertices:
+        return []
+    shm = multiprocessing.shared_memory.SharedMemory(name=shm_name)
+    try:
+        shm_vertices, shm_faces = _shared_mesh_arrays(shm, n_vertices, n_faces)
+        vertices = numpy.split(
+            numpy.array(shm_vertices), numpy.cumsum(n_vertices)[:-1])
+        faces = numpy.split(
+            numpy.array(shm_faces), numpy.cumsum(n_faces)[:-1])
+        del shm_vertices, shm_faces
+    finally:
+        shm.close()
+    return [meshparty.trimesh_io.Mesh(v, f, process=False)
+            for v, f in zip(vertices, faces)]
+
+
+def _radius_worker(cellname, skel, shm_desc):
+    """(cellname, status, mpskel, seconds, error) for one cell, where
+    status is "ok", "none" (no usable mesh intersection, as
+    mpskel_with_radius_from_skelcd_meshes_or_None) or "failed" """
+    t0 = time.perf_counter()
+    try:
+        meshes = _meshes_from_shared_memory(*shm_desc)
+        mpskel = mpskel_with_radius_from_skelcd_meshes(skel, meshes)
+        status, error = "ok", None
+    except IndexError:
+        mpskel, status, error = None, "none", None
+    except Exception:
+        mpskel, status, error = None, "failed", traceback.format_exc()
+    return cellname, status, mpskel, time.perf_counter() - t0, error
+
+
+def read_radius_job_report(checkpoint_dir):
+    """latest report record of each cell in a job's checkpoint_dir"""
+    report_path = pathlib.Path(checkpoint_dir) / REPORT_FILENAME
+    cn_to_record = {}
+    if report_path.is_file():
+        with report_path.open("r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # partial line from an interrupted write
+                    continue
+                cellname = record["cellname"]
+                if isinstance(cellname, list):
+                    cellname = tuple(cellname)
+                cn_to_record[cellname] = record
+    return cn_to_record
+
+
+def load_radius_job_results(checkpoint_dir, cellnames=None):
+    """cellname to mpskel (or None) for checkpointed cells"""
+    cells_path = pathlib.Path(checkpoint_dir) / CELLS_DIRNAME
+    cn_to_record = read_radius_job_report(checkpoint_dir)
+    cellnames = cn_to_record.keys() if cellnames is None else cellnames
+    cn_to_mpskel = {}
+    for cn in cellnames:
+        record = cn_to_record.get(cn)
+        if record is None or record["status"] == "failed":
+            continue
+        with (cells_path / record["filename"]).open("rb") as f:
+            cn_to_mpskel[cn] = pickle.load(f)
+    return cn_to_mpskel
+
+
+def run_radius_job(cn_to_skelcd, cn_to_bbox_mesh, checkpoint_dir,
+                   cellnames=None, max_workers=None, max_in_flight=None,
+                   retry_failed=False):
+    """estimate radius skeletons (mpskel_with_radius_from_skelcd_meshes)
+    for cells in a process pool, checkpointing each cell in checkpoint_dir
+
+    cells already checkpointed in checkpoint_dir are skipped, as are
+    failed cells unless retry_failed.  Each finished cell appends a record
+    (cellname, status, seconds, error traceback) to report.jsonl.  Cells
+    with no skeleton or no bbox mesh (None) are recorded as "none".
+
+    Returns
+    -------
+    cn_to_mpskel : dict
+        cellname to mpskel (None where the meshes gave no radius) for
+        finished cells
+    cn_to_record : dict
+        cellname to latest report record
+    """
+    checkpoint_path = pathlib.Path(checkpoint_dir)
+    cells_path = checkpoint_path / CELLS_DIRNAME
+    cells_path.mkdir(parents=True, exist_ok=True)
+
+    if cellnames is None:
+        cellnames = [cn for cn in cn_to_skelcd if cn in cn_to_bbox_mesh]
+    cellnames = list(cellnames)
+    cn_to_record = read_radius_job_report(checkpoint_path)
+    done_statuses = {"ok", "none"} if retry_failed else {"ok", "none", "failed"}
+    todo = [cn for cn in cellnames
+            if cn_to_record.get(cn, {}).get("status") not in done_statuses]
+    print("{} of {} cells to process".format(len(todo), len(cellnames)))
+
+    max_workers = max_workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * max_workers
+
+    def record_result(report_f, result):
+        cellname, status, mpskel, seconds, error = result
+        filename = _cell_filename(cellname)
+        if status != "failed":
+            tmp_path = cells_path / (filename + ".tmp")
+            with tmp_path.open("wb") as f:
+                pickle.dump(mpskel, f)
+            os.replace(tmp_path, cells_path / filename)
+        record = {
+            "cellname": cellname,
+            "status": status,
+            "seconds": seconds,
+            "filename": filename,
+            "error": error
+        }
+        report_f.write(json.dumps(record, cls=CiliaAnalysisJsonEncoder) + "\n")
+        report_f.flush()
+        cn_to_record[cellname] = record
+        if status == "failed":
+            print("{} failed: {}".format(cellname, error.splitlines()[-1]))
+
+    with (checkpoint_path / REPORT_FILENAME).open("a") as report_f, \
+            concurrent.futures.ProcessPoolExecutor(max_workers) as e:
+        in_flight = {}
+
+        def wait_and_record(return_when):
+            finished, _ = concurrent.futures.wait(
+                in_flight, return_when=return_when)
+            for fut in finished:
+                shm = in_flight.pop(fut)
+                shm.close()
+                shm.unlink()
+                record_result(report_f, fut.result())
+
+        try:
+            for cn in todo:
+                skelcd = cn_to_skelcd[cn]
+                meshes = cn_to_bbox_mesh[cn]
+                if skelcd is None or meshes is None:
+                    record_result(report_f, (cn, "none", None, 0.0, None))
+                    continue
+                try:
+                    skel = tuple(skeleton_vtxs_edges_rootid(skelcd))
+                except Exception:
+                    record_result(report_f, (
+                        cn, "failed", None, 0.0, traceback.format_exc()))
+                    continue
+                shm, shm_desc = _meshes_to_shared_memory(_mesh_list(meshes))
+                try:
+                    fut = e.submit(_radius_worker, cn, skel, shm_desc)
+                except BaseException:
+                    shm.close()
+                    shm.unlink()
+                    raise
+                in_flight[fut] = shm
+                if len(in_flight) >= max_in_flight:
+                    wait_and_record(concurrent.futures.FIRST_COMPLETED)
+            wait_and_record(concurrent.futures.ALL_COMPLETED)
+        finally:
+            for fut, shm in in_flight.items():
+                fut.cancel()
+                shm.close()
+                shm.unlink()
+
+    status_counts = collections.Counter(
+        cn_to_record[cn]["status"] for cn in cellnames if cn in cn_to_record)
+    print("radius job status: {}".format(dict(status_counts)))
+    return (load_radius_job_results(checkpoint_path, cellnames),
+            {cn: cn_to_record[cn] for cn in cellnames if cn in cn_to_record})
@@ -1,7 +1,13 @@
+import base64
+import concurrent.futures
+import contextlib
 import json
+import os
 
 import numpy
 
+import pycilium.cilia
+
 
 class CiliaAnalysisJsonEncoder(json.JSONEncoder):
     """json Encoder in the following hierarchy for serialization:
@@ -39,3 +45,113 @@ class CiliaAnalysisJsonEncoder(json.JSONEncoder):
                     return super(CiliaAnalysisJsonEncoder, self).default(obj)
                 except TypeError:  # pragma: no cover
                     return obj.__dict__
+
+
+NDARRAY_TAG = "__ndarray__"
+
+
+def encode_ndarray(arr, inline_max_size=16):
+    """json-encodable tagged dict for a numeric array.  Small arrays are
+    inlined as a flat list, larger arrays as base64 of the raw buffer."""
+    if arr.dtype == object:
+        return arr.tolist()
+    arr = numpy.ascontiguousarray(arr)
+    data = (arr.ravel().tolist() if arr.size <= inline_max_size
+            else base64.b64encode(arr.tobytes()).decode("ascii"))
+    return {NDARRAY_TAG: data, "dtype": arr.dtype.str,
+            "shape": list(arr.shape)}
+
+
+def decode_ndarray(d):
+    data = d[NDARRAY_TAG]
+    dtype = numpy.dtype(d["dtype"])
+    if isinstance(data, str):
+        arr = numpy.frombuffer(base64.b64decode(data), dtype=dtype).copy()
+    else:
+        arr = numpy.array(data, dtype=dtype)
+    return arr.reshape(d["shape"])
+
+
+def cilia_analysis_object_hook(d):
+    """json object_hook restoring arrays encoded by encode_ndarray"""
+    return decode_ndarray(d) if NDARRAY_TAG in d else d
+
+
+class CiliaAnalysisCompactJsonEncoder(CiliaAnalysisJsonEncoder):
+    """CiliaAnalysisJsonEncoder that encodes numpy arrays with
+    encode_ndarray so they decode back to arrays with
+    cilia_analysis_object_hook"""
+    def default(self, obj):
+        if isinstance(obj, numpy.ndarray):
+            return encode_ndarray(obj)
+        if isinstance(obj, numpy.floating):
+            return float(obj)
+        return super(CiliaAnalysisCompactJsonEncoder, self).default(obj)
+
+
+@contextlib.contextmanager
+def _binary_file(fp, mode):
+    if isinstance(fp, (str, os.PathLike)):
+        with open(fp, mode) as f:
+            yield f
+    else:
+        yield fp
+
+
+def write_cilobjs_ndjson(cilobjs, fp):
+    """write one cilobj per line to a path or binary file, consuming
+    cilobjs as an iterable.  Returns the number of cells written."""
+    encoder = CiliaAnalysisCompactJsonEncoder(separators=(",", ":"))
+    n = 0
+    with _binary_file(fp, "wb") as f:
+        for cilobj in cilobjs:
+            f.write(encoder.encode(cilobj).encode("utf8"))
+            f.write(b"\n")
+            n += 1
+    return n
+
+
+def iter_cilobjs_ndjson(fp, start=0, end=None):
+    """yield cilobjs from an ndjson path or binary file.  Only lines that
+    begin within the byte range [start, end) are read, so disjoint ranges
+    can be read independently."""
+    with _binary_file(fp, "rb") as f:
+        if start > 0:
+            # a line starting before the range belongs to the previous one
+            f.seek(start - 1)
+            if f.read(1) != b"\n":
+                f.readline()
+        else:
+            f.seek(0)
+        while end is None or f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            yield pycilium.cilia.CiliaAnalysisAnnotatedCell._from_dict(
+                json.loads(line, object_hook=cilia_analysis_object_hook))
+
+
+def read_cilobjs_ndjson(fp, start=0, end=None):
+    return [*iter_cilobjs_ndjson(fp, start=start, end=end)]
+
+
+def ndjson_byte_ranges(path, n_ranges):
+    """split a file into n_ranges contiguous byte ranges for
+    iter_cilobjs_ndjson"""
+    size = os.path.getsize(path)
+    bounds = numpy.linspace(0, size, n_ranges + 1).astype(int)
+    return [(int(s), int(e)) for s, e in zip(bounds[:-1], bounds[1:])
+            if e > s]
+
+
+def read_cilobjs_ndjson_parallel(path, max_workers=None, n_ranges=None):
+    """read an ndjson file by byte range in a process pool, preserving
+    line order"""
+    n_ranges = n_ranges or max_workers or os.cpu_count() or 1
+    ranges = ndjson_byte_ranges(path, n_ranges)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as e:
+        futs = [e.submit(read_cilobjs_ndjson, path, start, end)
+                for start, end in ranges]
+        return [cilobj for fut in futs for cilobj in fut.result()]
@@ -1,111 +1,597 @@
+import weakref
+
 import numpy
 import pandas
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.spatial
 
 
 def vtxs_edges_to_linesegments(vtxs, edges):
     return [(vtxs[i], vtxs[j]) for i, j in edges]
 
 
-def vtxs_edges_rootid_read_compact_detail(compactdetail, **kwargs):
+def treenode_ids_to_idxs(treenode_ids, query_ids, sorter=None):
+    """vertex indices of query_ids in treenode_ids by sorted-id search"""
+    sorter = numpy.argsort(treenode_ids) if sorter is None else sorter
+    query_ids = numpy.asarray(query_ids, dtype=numpy.int64)
+    pos = numpy.searchsorted(treenode_ids, query_ids, sorter=sorter)
+    idxs = sorter[numpy.clip(pos, 0, len(sorter) - 1)]
+    missing = treenode_ids[idxs] != query_ids
+    if missing.any():
+        raise ValueError("treenodes {} are not in the skeleton".format(
+            query_ids[missing].tolist()))
+    return idxs
+
+
+def read_compact_detail_arrays(compactdetail):
+    """vertices, edges ([parent, child] vertex indices), root index and
+    vertex properties (treenode_ids, parent_ids, radius and tags) from a
+    CATMAID compact-detail skeleton"""
     nodes, conns, tags, _something, annos = compactdetail
 
     if conns:
         raise NotImplementedError("Connectors are not supported!")
+    if not len(nodes):
+        raise ValueError("compact-detail skeleton has no nodes")
+
+    # compact-detail nodes are id, parent, userid, x, y, z, radius, confidence
+    node_arr = numpy.array(nodes, dtype=object)
+    treenode_ids = node_arr[:, 0].astype(numpy.int64)
+    is_root = numpy.equal(node_arr[:, 1], None)
+    if not is_root.any():
+        raise ValueError("compact-detail skeleton has no root node")
+    parent_ids = numpy.where(is_root, -1, node_arr[:, 1]).astype(numpy.int64)
+    vtxs = node_arr[:, 3:6].astype(float)
+    radius = node_arr[:, 6].astype(float)
+    radius[radius < 0] = numpy.nan
 
-    treenode_to_idx = {}
-    vtxs = []
-    vtx_relation = []
-
-    for i, node in enumerate(nodes):
-        vtxs.append(node[3:6])
-        tn = node[0]
-        parent = node[1]
-        if parent is None:
-            root_idx = i
-        else:
-            vtx_relation.append([parent, tn])
-
-        treenode_to_idx[tn] = i
-
-    # # invert mapping for tags
-    # treenode_to_labels = {}
-    # for label, treenodes in tags.items():
-    #     for treenode in treenodes:
-    #         try:
-    #             treenode_to_labels[treenode].append(label)
-    #         except KeyError:
-    #             treenode_to_labels[treenode] = [label]
-
-    # idx_to_treenode = {v: k for k, v in treenode_to_idx.items()}
-    # treenode_arr = numpy.array(list(treenode_to_idx.keys()))
-    # tag_arr = numpy.array([treenode_to_labels.get(tn, []) for tn in treenode_arr])
-    # vtx_props = {
-    #     "tags": tag_arr,
-    #     "treenode_ids": treenode_arr
-    # }
-
-    edges = [[treenode_to_idx.get(i), treenode_to_idx.get(j)]
-             for i, j in vtx_relation]
-
-    # cvskel = cloudvolume.skeleton.PrecomputedSkeleton(numpy.array(vtxs), numpy.array(edges), **kwargs)
-    # return cvskel
-    # nglskel = neuroglancer.skeleton.Skeleton(numpy.array(vtxs), numpy.array(edges))  # , numpy.array(vtx_props))
-    # return nglskel
-    # mpskel = meshparty.skeleton.Skeleton(numpy.array(vtxs), numpy.array(edges), vertex_properties=vtx_props, root=root_idx)
-    # return mpskel
-    return numpy.array(vtxs), numpy.array(edges), root_idx
+    sorter = numpy.argsort(treenode_ids)
+    child_idxs = numpy.flatnonzero(~is_root)
+    parent_idxs = treenode_ids_to_idxs(
+        treenode_ids, parent_ids[child_idxs], sorter=sorter)
+    edges = numpy.stack([parent_idxs, child_idxs], axis=1)
+    # as in a walk over the nodes, the last root wins
+    root_idx = int(numpy.flatnonzero(is_root)[-1])
+
+    vtx_tags = numpy.empty(len(nodes), dtype=object)
+    vtx_tags[:] = [()] * len(nodes)
+    for label, label_treenodes in (tags or {}).items():
+        for idx in treenode_ids_to_idxs(
+                treenode_ids, label_treenodes, sorter=sorter):
+            vtx_tags[idx] = vtx_tags[idx] + (label,)
+
+    vtx_props = {
+        "treenode_ids": treenode_ids,
+        "parent_ids": parent_ids,
+        "radius": radius,
+        "tags": vtx_tags
+    }
+    return vtxs, edges, root_idx, vtx_props
+
+
+def vtxs_edges_rootid_read_compact_detail(compactdetail, **kwargs):
+    vtxs, edges, root_idx, _ = read_compact_detail_arrays(compactdetail)
+    return vtxs, edges, root_idx
+
+
+def skeleton_vtxs_edges_rootid(skel):
+    """vertices, edges ([parent, child]) and root index of a compact-detail
+    skeleton, a PackedSkeleton (or other object providing
+    vtxs_edges_rootid), a meshparty-like skeleton or a
+    (vtxs, edges, root) tuple"""
+    vtxs_edges_rootid = getattr(skel, "vtxs_edges_rootid", None)
+    if callable(vtxs_edges_rootid):
+        return vtxs_edges_rootid()
+    if all(hasattr(skel, k) for k in ("vertices", "edges", "root")):
+        return skel.vertices, skel.edges, skel.root
+    if len(skel) == 3 and isinstance(skel[0], numpy.ndarray):
+        return skel
+    return vtxs_edges_rootid_read_compact_detail(skel)
 
 
 def skelcd_to_linesegments(skelcd):
-    vtxs, edges, rootid = vtxs_edges_rootid_read_compact_detail(skelcd)
+    vtxs, edges, rootid = skeleton_vtxs_edges_rootid(skelcd)
     return vtxs_edges_to_linesegments(vtxs, edges)
 
 
+swc_columns = ["node_id", "parent_id", "x", "y", "z", "radius"]
+
+
 def cdskel_to_swc(cdskel):
+    if hasattr(cdskel, "treenode_ids"):
+        # PackedSkeleton parents are vertex indices
+        is_root = cdskel.parents < 0
+        vtxs = numpy.asarray(cdskel.vertices)
+        return pandas.DataFrame({
+            "node_id": numpy.asarray(cdskel.treenode_ids),
+            "parent_id": numpy.where(
+                is_root, -1,
+                cdskel.treenode_ids[numpy.maximum(cdskel.parents, 0)]),
+            "x": vtxs[:, 0],
+            "y": vtxs[:, 1],
+            "z": vtxs[:, 2],
+            "radius": numpy.asarray(cdskel.radius)
+        }, columns=swc_columns)
+
     # cdskel swc is id, parent, userid, x, y, z, radius, confidence
-    cdskel_swc = cdskel[0]
-    data = [[
-        node_id,
-        (-1 if parent_id is None else parent_id),
-        x, y, z,
-        (None if radius < 0 else radius)
-    ] for (
-        node_id, parent_id, user_id,
-        x, y, z, radius, confidence) in cdskel_swc]
-
-    return pandas.DataFrame(
-        data=data,
-        columns=["node_id", "parent_id", "x", "y", "z", "radius"])
-
-
-# TODO this can be vectorized
-# TODO need to also get length along segment/path (here, ald)
+    node_arr = numpy.array(cdskel[0], dtype=object).reshape(-1, 8)
+    is_root = numpy.equal(node_arr[:, 1], None)
+    radius = node_arr[:, 6].astype(float)
+    radius[radius < 0] = numpy.nan
+
+    return pandas.DataFrame({
+        "node_id": node_arr[:, 0].astype(numpy.int64),
+        "parent_id": numpy.where(
+            is_root, -1, node_arr[:, 1]).astype(numpy.int64),
+        "x": node_arr[:, 3].astype(float),
+        "y": node_arr[:, 4].astype(float),
+        "z": node_arr[:, 5].astype(float),
+        "radius": radius
+    }, columns=swc_columns)
+
+
+def swc_to_vtxs_edges_rootid(swc):
+    """vertices, edges ([parent, child] vertex indices) and root index
+    from an swc table with swc_columns"""
+    node_ids = swc["node_id"].to_numpy(dtype=numpy.int64)
+    parent_ids = swc["parent_id"].to_numpy(dtype=numpy.int64)
+    vtxs = swc[["x", "y", "z"]].to_numpy(dtype=float)
+
+    is_root = parent_ids < 0
+    if not is_root.any():
+        raise ValueError("swc skeleton has no root node")
+    child_idxs = numpy.flatnonzero(~is_root)
+    parent_idxs = treenode_ids_to_idxs(node_ids, parent_ids[child_idxs])
+    edges = numpy.stack([parent_idxs, child_idxs], axis=1)
+    return vtxs, edges, int(numpy.flatnonzero(is_root)[-1])
+
+
+def vtxs_edges_rootid_to_swc(vtxs, edges, root, radius=None, node_ids=None):
+    """swc table for a tree skeleton given as vertex and edge arrays,
+    with edges in either orientation"""
+    vtxs = numpy.asarray(vtxs, dtype=float)
+    n = len(vtxs)
+    node_ids = (numpy.arange(1, n + 1) if node_ids is None
+                else numpy.asarray(node_ids, dtype=numpy.int64))
+    graph = scipy.sparse.csr_matrix(
+        (numpy.ones(len(edges)), tuple(numpy.asarray(edges).reshape(-1, 2).T)),
+        shape=(n, n))
+    _, predecessors = scipy.sparse.csgraph.breadth_first_order(
+        graph, root, directed=False, return_predecessors=True)
+    has_parent = predecessors >= 0
+
+    parent_ids = numpy.full(n, -1, dtype=numpy.int64)
+    parent_ids[has_parent] = node_ids[predecessors[has_parent]]
+    return pandas.DataFrame({
+        "node_id": node_ids,
+        "parent_id": parent_ids,
+        "x": vtxs[:, 0],
+        "y": vtxs[:, 1],
+        "z": vtxs[:, 2],
+        "radius": (numpy.full(n, numpy.nan) if radius is None
+                   else numpy.asarray(radius, dtype=float))
+    }, columns=swc_columns)
+
+
+def _project_points_to_segment_pairs(pts, seg_starts, seg_ends):
+    """projection of pts[i] onto segment i for equal-length arrays"""
+    seg_vecs = seg_ends - seg_starts
+    seg_lens = numpy.linalg.norm(seg_vecs, axis=-1)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        t = numpy.einsum("...j,...j->...", pts - seg_starts, seg_vecs) / (
+            seg_lens ** 2)
+    t = numpy.clip(numpy.nan_to_num(t, nan=0.0), 0, 1)
+    proj_pts = seg_starts + t[..., None] * seg_vecs
+    dists = numpy.linalg.norm(pts - proj_pts, axis=-1)
+    return proj_pts, t * seg_lens, dists
+
+
+def _project_points_to_segments_bruteforce(pts, seg_starts, seg_ends,
+                                           max_block_elements):
+    n_pts, n_segs = len(pts), len(seg_starts)
+    block_size = max(1, max_block_elements // max(n_segs, 1))
+    seg_idxs = numpy.empty(n_pts, dtype=int)
+    for i in range(0, n_pts, block_size):
+        block = slice(i, i + block_size)
+        _, _, dists = _project_points_to_segment_pairs(
+            pts[block, None, :], seg_starts[None], seg_ends[None])
+        seg_idxs[block] = numpy.argmin(dists, axis=1)
+    return seg_idxs
+
+
+def _project_points_to_segments_tree(pts, seg_starts, seg_ends):
+    """exact nearest segments using a kd-tree over segment midpoints: any
+    segment closer than the nearest-midpoint segment has its midpoint
+    within that distance plus the longest half segment length"""
+    midpts = (seg_starts + seg_ends) / 2
+    max_half_len = numpy.linalg.norm(seg_ends - seg_starts, axis=1).max() / 2
+    tree = scipy.spatial.cKDTree(midpts)
+
+    _, first_idxs = tree.query(pts)
+    _, _, upper_bounds = _project_points_to_segment_pairs(
+        pts, seg_starts[first_idxs], seg_ends[first_idxs])
+    candidates = tree.query_ball_point(pts, upper_bounds + max_half_len)
+
+    # the nearest-midpoint segment is always a candidate, as rounding can
+    #   leave it out of the ball when the bound is tight
+    counts = numpy.array([len(c) for c in candidates]) + 1
+    pt_idxs = numpy.concatenate([
+        numpy.repeat(numpy.arange(len(pts)), counts - 1),
+        numpy.arange(len(pts))])
+    cand_idxs = numpy.concatenate(
+        [numpy.concatenate(candidates).astype(int), first_idxs])
+    _, _, dists = _project_points_to_segment_pairs(
+        pts[pt_idxs], seg_starts[cand_idxs], seg_ends[cand_idxs])
+
+    # per point minimum over its run of candidates
+    order = numpy.lexsort((dists, pt_idxs))
+    run_starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+    return cand_idxs[order[run_starts]]
+
+
+def project_points_to_segments(pts, seg_starts, seg_ends, use_tree=None,
+                               max_block_elements=2**22):
+    """project each point onto its nearest segment
+
+    Parameters
+    ----------
+    pts : numpy.array
+        Nx3 query points
+    seg_starts, seg_ends : numpy.array
+        Sx3 segment end points
+    use_tree : bool or None
+        prune candidate segments with a kd-tree over segment midpoints.
+        default (None) uses it when N x S exceeds max_block_elements
+    max_block_elements : int
+        bound on point-segment pairs evaluated at once without the tree
+
+    Returns
+    -------
+    seg_idxs : numpy.array
+        N nearest segment indices
+    proj_pts : numpy.array
+        Nx3 nearest points on those segments
+    along : numpy.array
+        N distances from segment start to the nearest point
+    dists : numpy.array
+        N perpendicular (nearest) distances
+    """
+    pts = numpy.asarray(pts, dtype=float).reshape(-1, 3)
+    seg_starts = numpy.asarray(seg_starts, dtype=float).reshape(-1, 3)
+    seg_ends = numpy.asarray(seg_ends, dtype=float).reshape(-1, 3)
+    if not len(seg_starts):
+        raise ValueError("no segments to project onto")
+    if use_tree is None:
+        use_tree = len(pts) * len(seg_starts) > max_block_elements
+
+    seg_idxs = (
+        _project_points_to_segments_tree(pts, seg_starts, seg_ends)
+        if use_tree else _project_points_to_segments_bruteforce(
+            pts, seg_starts, seg_ends, max_block_elements))
+    proj_pts, along, dists = _project_points_to_segment_pairs(
+        pts, seg_starts[seg_idxs], seg_ends[seg_idxs])
+    return seg_idxs, proj_pts, along, dists
+
+
+def project_points_to_skeleton(vtxs, edges, pts, **kwargs):
+    """project_points_to_segments onto skeleton edges, with along measured
+    from the vertex edges[:, 0]"""
+    return project_points_to_segments(
+        pts, vtxs[edges[:, 0]], vtxs[edges[:, 1]], **kwargs)
+
+
 def nearest_point_on_segment(seg_start, seg_end, pt):
-    line_vec = seg_start - seg_end
-    d = pt - seg_start
+    """nearest point, distance along segment from seg_start, and distance
+    from pt"""
+    nearest_points, alds, dists = _project_points_to_segment_pairs(
+        numpy.asarray(pt, dtype=float), numpy.asarray(seg_start, dtype=float),
+        numpy.asarray(seg_end, dtype=float))
+    return nearest_points, alds, dists
+
+
+def _skeleton_parents(n, edges, root):
+    """parent vertex index (-1 for roots) of each vertex with edges
+    oriented away from root.  Components not connected to root are rooted
+    at their lowest vertex index."""
+    edges = numpy.asarray(edges, dtype=int).reshape(-1, 2)
+    graph = scipy.sparse.csr_matrix(
+        (numpy.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(n, n))
+    parents = numpy.full(n, -1, dtype=int)
+    unvisited = numpy.ones(n, dtype=bool)
+    component_root = root
+    while True:
+        order, predecessors = scipy.sparse.csgraph.breadth_first_order(
+            graph, component_root, directed=False, return_predecessors=True)
+        parents[order[1:]] = predecessors[order[1:]]
+        unvisited[order] = False
+        if not unvisited.any():
+            return parents
+        component_root = int(numpy.argmax(unvisited))
+
+
+def skeleton_unbranched_paths(parents):
+    """vertex index paths between roots, branch points and leaves, each
+    ordered away from the root"""
+    n = len(parents)
+    has_parent = parents >= 0
+    child_idxs = numpy.flatnonzero(has_parent)
+    n_children = numpy.bincount(parents[child_idxs], minlength=n)
+    is_key = ~has_parent | (n_children != 1)
+    only_child = numpy.full(n, -1, dtype=int)
+    only_child[parents[child_idxs]] = child_idxs
+
+    paths = []
+    for start in child_idxs[is_key[parents[child_idxs]]]:
+        path = [parents[start], start]
+        cur = start
+        while not is_key[cur]:
+            cur = only_child[cur]
+            path.append(cur)
+        paths.append(path)
+    return paths, is_key
+
+
+def _douglas_peucker_keep(pts, tolerance):
+    keep = numpy.zeros(len(pts), dtype=bool)
+    keep[[0, -1]] = True
+    spans = [(0, len(pts) - 1)]
+    while spans:
+        s, e = spans.pop()
+        if e - s < 2:
+            continue
+        _, _, dists = _project_points_to_segment_pairs(
+            pts[s + 1:e], pts[s], pts[e])
+        i = int(numpy.argmax(dists))
+        if dists[i] > tolerance:
+            m = s + 1 + i
+            keep[m] = True
+            spans.extend([(s, m), (m, e)])
+    return keep
+
+
+def simplify_skeleton(skel, tolerance):
+    """Douglas-Peucker simplification of each unbranched path of a
+    skeleton so no removed vertex is farther than tolerance from the
+    simplified path.  Roots, branch points and leaves are kept.
+
+    Parameters
+    ----------
+    skel
+        skeleton accepted by skeleton_vtxs_edges_rootid
+    tolerance : float
+        maximum distance of a removed vertex from the simplified skeleton
+
+    Returns
+    -------
+    vtxs : numpy.array
+        kept vertices, in their original order
+    edges : numpy.array
+        [parent, child] vertex indices
+    root : int
+        root vertex index
+    """
+    vtxs, edges, root = skeleton_vtxs_edges_rootid(skel)
+    vtxs = numpy.asarray(vtxs, dtype=float)
+    paths, keep = skeleton_unbranched_paths(
+        _skeleton_parents(len(vtxs), edges, root))
+    keep = keep.copy()
+    path_keeps = []
+    for path in paths:
+        path = numpy.asarray(path)
+        path_keep = path[_douglas_peucker_keep(vtxs[path], tolerance)]
+        keep[path_keep] = True
+        path_keeps.append(path_keep)
+
+    new_idxs = numpy.cumsum(keep) - 1
+    new_edges = numpy.concatenate(
+        [numpy.stack([new_idxs[p[:-1]], new_idxs[p[1:]]], axis=1)
+         for p in path_keeps] or [numpy.empty((0, 2), dtype=int)])
+    return vtxs[keep], new_edges, int(new_idxs[root])
+
+
+def resample_skeleton(skel, spacing):
+    """resample each unbranched path of a skeleton to vertices evenly
+    spaced along the path at most spacing apart.  Roots, branch points and
+    leaves keep their positions.
+
+    Parameters
+    ----------
+    skel
+        skeleton accepted by skeleton_vtxs_edges_rootid
+    spacing : float
+        maximum path length between consecutive vertices
+
+    Returns
+    -------
+    vtxs : numpy.array
+        root, branch point and leaf vertices in their original order
+        followed by the resampled path vertices
+    edges : numpy.array
+        [parent, child] vertex indices
+    root : int
+        root vertex index
+    """
+    if not spacing > 0:
+        raise ValueError(
+            "resample spacing must be positive, not {}".format(spacing))
+    vtxs, edges, root = skeleton_vtxs_edges_rootid(skel)
+    vtxs = numpy.asarray(vtxs, dtype=float)
+    paths, is_key = skeleton_unbranched_paths(
+        _skeleton_parents(len(vtxs), edges, root))
+    key_idxs = numpy.flatnonzero(is_key)
+    new_idxs = numpy.full(len(vtxs), -1, dtype=int)
+    new_idxs[key_idxs] = numpy.arange(len(key_idxs))
+
+    new_vtxs = [vtxs[key_idxs]]
+    new_edges = [numpy.empty((0, 2), dtype=int)]
+    n_new = len(key_idxs)
+    for path in paths:
+        path_vtxs = vtxs[path]
+        arclen = numpy.concatenate([[0], numpy.cumsum(numpy.linalg.norm(
+            numpy.diff(path_vtxs, axis=0), axis=1))])
+        n_segs = max(1, int(numpy.ceil(arclen[-1] / spacing)))
+        sample_arclen = numpy.linspace(0, arclen[-1], n_segs + 1)[1:-1]
+        new_vtxs.append(numpy.stack(
+            [numpy.interp(sample_arclen, arclen, path_vtxs[:, j])
+             for j in range(path_vtxs.shape[1])], axis=1))
+        path_idxs = numpy.concatenate([
+            [new_idxs[path[0]]],
+            numpy.arange(n_new, n_new + len(sample_arclen)),
+            [new_idxs[path[-1]]]])
+        n_new += len(sample_arclen)
+        new_edges.append(numpy.stack([path_idxs[:-1], path_idxs[1:]], axis=1))
+    return (numpy.concatenate(new_vtxs), numpy.concatenate(new_edges),
+            int(new_idxs[root]))
 
-    mag = numpy.linalg.norm(line_vec)
-    u = line_vec - mag 
 
-    ald = numpy.dot(d, u)
-    ald = numpy.clip(ald, 0, mag)
+class SkeletonPathIndex:
+    """parent, distance-to-root, depth and ancestor (binary lifting)
+    arrays of a rooted tree skeleton, so path lengths between vertices or
+    arbitrary points are O(1)/O(log n) array lookups
 
-    nearest_point = seg_start + u * ald
+    Parameters
+    ----------
+    vtxs : numpy.array
+        Nx3 vertices
+    edges : numpy.array
+        Ex2 vertex indices, in either orientation
+    root : int
+        root vertex index
+    """
+    def __init__(self, vtxs, edges, root):
+        self.vertices = numpy.asarray(vtxs, dtype=float)
+        self.edges = numpy.asarray(edges, dtype=int).reshape(-1, 2)
+        self.root = int(root)
+        n = len(self.vertices)
 
-    dist = numpy.linalg.norm(d - nearest_point)
-    return nearest_point, ald, dist
+        graph = scipy.sparse.csr_matrix(
+            (numpy.ones(len(self.edges)),
+             (self.edges[:, 0], self.edges[:, 1])), shape=(n, n))
+        order, predecessors = scipy.sparse.csgraph.breadth_first_order(
+            graph, self.root, directed=False, return_predecessors=True)
+        if len(order) != n:
+            raise ValueError(
+                "{} vertices are not connected to the root".format(
+                    n - len(order)))
+
+        self.parents = predecessors.astype(int)
+        self.parents[self.root] = -1
+
+        # pointer jumping: after k rounds each vertex has accumulated the
+        #   lengths and hops of its 2**k nearest ancestor edges
+        parent_or_self = numpy.where(
+            self.parents < 0, numpy.arange(n), self.parents)
+        dist = numpy.linalg.norm(
+            self.vertices - self.vertices[parent_or_self], axis=1)
+        hops = (self.parents >= 0).astype(int)
+        ancestors = [parent_or_self]
+        for _ in range(max(1, int(numpy.ceil(numpy.log2(max(n, 2)))))):
+            up = ancestors[-1]
+            dist = dist + dist[up]
+            hops = hops + hops[up]
+            ancestors.append(up[up])
+        self.distance_to_root = dist
+        self.depth = hops
+        self._ancestors = numpy.stack(ancestors)
+
+        # per edge, the endpoint farther from the root and the offset of the
+        #   edge start along the path to root
+        is_child_first = self.parents[self.edges[:, 0]] == self.edges[:, 1]
+        self.edge_child = numpy.where(
+            is_child_first, self.edges[:, 0], self.edges[:, 1])
+        self.edge_start_offsets = self.distance_to_root[self.edges[:, 0]]
+        self.edge_directions = numpy.where(is_child_first, -1.0, 1.0)
+
+    @classmethod
+    def from_skeleton(cls, mpskel):
+        return cls(mpskel.vertices, mpskel.edges, mpskel.root)
+
+    def lca(self, u, v):
+        """lowest common ancestors of vertex index arrays u and v"""
+        u = numpy.array(u, dtype=int, ndmin=1)
+        v = numpy.array(v, dtype=int, ndmin=1)
+        swap = self.depth[u] < self.depth[v]
+        u, v = numpy.where(swap, v, u), numpy.where(swap, u, v)
+
+        diff = self.depth[u] - self.depth[v]
+        for level, up in enumerate(self._ancestors):
+            move = ((diff >> level) & 1).astype(bool)
+            u = numpy.where(move, up[u], u)
+
+        same = u == v
+        for up in self._ancestors[::-1]:
+            move = up[u] != up[v]
+            u = numpy.where(move, up[u], u)
+            v = numpy.where(move, up[v], v)
+        return numpy.where(same, u, self._ancestors[0][u])
+
+    def vertex_pathlengths(self, u, v):
+        """path lengths along the skeleton between vertex index arrays"""
+        u = numpy.array(u, dtype=int, ndmin=1)
+        v = numpy.array(v, dtype=int, ndmin=1)
+        return (self.distance_to_root[u] + self.distance_to_root[v] -
+                2 * self.distance_to_root[self.lca(u, v)])
+
+    def project_points(self, pts, **kwargs):
+        """project_points_to_skeleton plus each projected point's path
+        length to root
+
+        Returns
+        -------
+        seg_idxs, proj_pts, along, dists : numpy.array
+            as in project_points_to_segments
+        pathlengths : numpy.array
+            path length from the root to each projected point
+        """
+        seg_idxs, proj_pts, along, dists = project_points_to_skeleton(
+            self.vertices, self.edges, pts, **kwargs)
+        pathlengths = (self.edge_start_offsets[seg_idxs] +
+                       self.edge_directions[seg_idxs] * along)
+        return seg_idxs, proj_pts, along, dists, pathlengths
+
+    def pathlength_to_points(self, pts, **kwargs):
+        """path length from root to the nearest skeleton point of each pt"""
+        return self.project_points(pts, **kwargs)[-1]
+
+    def pathlength_between_points(self, pts_a, pts_b, **kwargs):
+        """path length along the skeleton between the nearest skeleton
+        points of pts_a[i] and pts_b[i]"""
+        seg_a, _, _, _, pl_a = self.project_points(pts_a, **kwargs)
+        seg_b, _, _, _, pl_b = self.project_points(pts_b, **kwargs)
+        # the lca of the edge children is above both points unless one
+        #   point's edge is on the other's path to root, in which case the
+        #   nearer-to-root point is where the paths meet
+        lca_pl = self.distance_to_root[
+            self.lca(self.edge_child[seg_a], self.edge_child[seg_b])]
+        meet_pl = numpy.minimum(numpy.minimum(pl_a, pl_b), lca_pl)
+        return pl_a + pl_b - 2 * meet_pl
+
+
+_skeleton_path_index_cache = weakref.WeakKeyDictionary()
+
+
+def get_skeleton_path_index(mpskel):
+    """SkeletonPathIndex for a skeleton, cached for the lifetime of the
+    skeleton object and rebuilt if its root or size changes"""
+    try:
+        path_index = _skeleton_path_index_cache[mpskel]
+    except (KeyError, TypeError):
+        path_index = None
+    if (path_index is None or path_index.root != mpskel.root or
+            len(path_index.vertices) != len(mpskel.vertices)):
+        path_index = SkeletonPathIndex.from_skeleton(mpskel)
+        try:
+            _skeleton_path_index_cache[mpskel] = path_index
+        except TypeError:  # not weak referenceable
+            pass
+    return path_index
 
 
 def mpskel_pathlength_to_nearest_point(mpskel, pt):
-    start_pts, end_pts = zip(*vtxs_edges_to_linesegments(
-        mpskel.vertices, mpskel.edges))
-    allsegments_distances = [
-        (i, *nearest_point_on_segment(seg_start, seg_end, pt))
-        for i, (seg_start, seg_end)
-        in enumerate(zip(start_pts, end_pts))]
-    nearest_idx, nearest_pt, length_along_segment, dist = sorted(
-        allsegments_distances, key=lambda x: x[-1])[0]
-    nearest_start_node = mpskel.edges[nearest_idx][0]
-    return mpskel.path_length(
-        [mpskel.path_to_root(nearest_start_node)])[0] + length_along_segment
-    
+    return mpskel_pathlength_to_nearest_points(mpskel, [pt])[0]
+
+
+def mpskel_pathlength_to_nearest_points(mpskel, pts, **kwargs):
+    return get_skeleton_path_index(mpskel).pathlength_to_points(
+        pts, **kwargs)
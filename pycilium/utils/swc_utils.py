@@ -0,0 +1,140 @@
+"""
+streaming and parallel SWC file I/O
+
+swc tables are pandas DataFrames with the columns of
+skeleton_utils.swc_columns (node_id, parent_id, x, y, z, radius) and
+optionally a structure "type" column.  Unset (negative) radii read as NaN
+and are written as -1.
+"""
+import collections
+import concurrent.futures
+import io
+import os
+import pathlib
+import tarfile
+
+import numpy
+import pandas
+
+from pycilium.utils.skeleton_utils import swc_columns
+
+swc_file_columns = ["node_id", "type", "x", "y", "z", "radius", "parent_id"]
+
+
+def parse_swc(text):
+    """swc table from the text (str or bytes) of an swc file"""
+    if isinstance(text, bytes):
+        text = text.decode("utf8")
+    swc = pandas.read_csv(
+        io.StringIO(text), sep=r"\s+", comment="#", header=None,
+        float_precision="round_trip",
+        names=swc_file_columns, dtype={
+            "node_id": numpy.int64, "type": numpy.int64,
+            "parent_id": numpy.int64, "x": float, "y": float, "z": float,
+            "radius": float})
+    swc.loc[swc["radius"] < 0, "radius"] = numpy.nan
+    return swc[swc_columns + ["type"]]
+
+
+def format_swc(swc, header=None):
+    """swc file text for an swc table"""
+    types = (swc["type"].to_numpy() if "type" in swc
+             else numpy.zeros(len(swc), dtype=int))
+    radius = numpy.nan_to_num(
+        swc["radius"].to_numpy(dtype=float), nan=-1.0)
+    out = io.StringIO()
+    if header:
+        out.writelines("# {}\n".format(line) for line in header.splitlines())
+    pandas.DataFrame({
+        "node_id": swc["node_id"].to_numpy(dtype=numpy.int64),
+        "type": types,
+        "x": swc["x"].to_numpy(dtype=float),
+        "y": swc["y"].to_numpy(dtype=float),
+        "z": swc["z"].to_numpy(dtype=float),
+        "radius": radius,
+        "parent_id": swc["parent_id"].to_numpy(dtype=numpy.int64)
+    }, columns=swc_file_columns).to_csv(
+        out, sep=" ", header=False, index=False, lineterminator="\n")
+    return out.getvalue()
+
+
+def read_swc(path):
+    with open(path, "rb") as f:
+        return parse_swc(f.read())
+
+
+def write_swc(swc, path, header=None):
+    with open(path, "w") as f:
+        f.write(format_swc(swc, header=header))
+
+
+def _bounded_parallel_map(func, items, max_workers=None, max_in_flight=None):
+    """yield func(item) in order from a process pool, with at most
+    max_in_flight items submitted and unconsumed at a time"""
+    max_workers = max_workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 4 * max_workers
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as e:
+        futs = collections.deque()
+        for item in items:
+            futs.append(e.submit(func, item))
+            if len(futs) >= max_in_flight:
+                yield futs.popleft().result()
+        while futs:
+            yield futs.popleft().result()
+
+
+def _named_parse_swc(name_text):
+    name, text = name_text
+    return name, parse_swc(text)
+
+
+def _parse_named_texts(named_texts, max_workers):
+    if max_workers is None or max_workers <= 1:
+        return (_named_parse_swc(nt) for nt in named_texts)
+    return _bounded_parallel_map(
+        _named_parse_swc, named_texts, max_workers=max_workers)
+
+
+def iter_swc_directory(path, pattern="*.swc", max_workers=None):
+    """yield (filename, swc table) for swc files in a directory in sorted
+    order.  With max_workers > 1 files are parsed in a process pool with a
+    bounded number in flight."""
+    def named_texts():
+        for fn in sorted(pathlib.Path(path).glob(pattern)):
+            yield fn.name, fn.read_bytes()
+    return _parse_named_texts(named_texts(), max_workers)
+
+
+def iter_swc_archive(path, max_workers=None):
+    """yield (member name, swc table) from a (possibly compressed) tar
+    archive of swc files, reading it as a stream"""
+    def named_texts():
+        with tarfile.open(path, "r|*") as tf:
+            for member in tf:
+                if member.isfile():
+                    yield member.name, tf.extractfile(member).read()
+    return _parse_named_texts(named_texts(), max_workers)
+
+
+def write_swc_archive(named_swcs, path, mode="w:gz"):
+    """write (name, swc table) pairs to a tar archive one at a time.
+    Returns the number of files written."""
+    n = 0
+    with tarfile.open(path, mode) as tf:
+        for name, swc in named_swcs:
+            data = format_swc(swc).encode("utf8")
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+            n += 1
+    return n
+
+
+def write_swc_directory(named_swcs, path):
+    path = pathlib.Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    n = 0
+    for name, swc in named_swcs:
+        write_swc(swc, path / name)
+        n += 1
+    return n
@@ -0,0 +1,79 @@
+import types
+
+import numpy
+import pytest
+
+import cloudvolume
+from cloudvolume import Mesh
+
+from pycilium.utils import cloudvolume_utils
+
+
+class _MeshSource:
+    """mesh source with two fragments per segid along x"""
+    def __init__(self, segids):
+        rng = numpy.random.default_rng(0)
+        self.fragments = {}
+        for segid in segids:
+            for k in range(2):
+                fn = "{}:0:{}-{}_0-64_0-40".format(segid, k * 64, k * 64 + 64)
+                self.fragments[fn] = Mesh(
+                    rng.random((4, 3)).astype(numpy.float32),
+                    rng.integers(0, 4, (4, 3)).astype(numpy.uint32)
+                ).to_precomputed()
+
+    def exists(self, segids):
+        return {segid: "x" for segid in segids}
+
+    def _get_manifests(self, segids):
+        return {segid: [fn for fn in self.fragments
+                        if fn.startswith("{}:".format(segid))]
+                for segid in segids}
+
+    def _get_mesh_fragments(self, fns):
+        return [(fn, self.fragments[fn]) for fn in fns]
+
+
+def _mesh_cv(cloudpath):
+    return types.SimpleNamespace(
+        mesh=_MeshSource([1, 2]), mip=0, cloudpath=cloudpath)
+
+
+def test_bboxmesh_map_from_bbox_raises_without_fragments():
+    mesh_cv = _mesh_cv("test://bboxmesh_map")
+    bbox = cloudvolume.Bbox([0, 0, 0], [200, 600, 50])
+    far_bbox = cloudvolume.Bbox([50000, 0, 0], [60000, 600, 50])
+
+    segid_to_mesh = cloudvolume_utils.get_segid_to_bboxmesh_map_from_bbox(
+        mesh_cv, [1, 2], bbox, mesh_cache=False)
+    assert sorted(segid_to_mesh) == [1, 2]
+
+    with pytest.raises(ValueError):
+        cloudvolume_utils.get_segid_to_bboxmesh_map_from_bbox(
+            mesh_cv, [1, 2], far_bbox, mesh_cache=False)
+
+    # the batch API leaves segids without fragments out
+    (_, segid_to_mesh), = cloudvolume_utils.iter_segid_to_bboxmesh_maps(
+        mesh_cv, [("cell", [1, 2], far_bbox)], mesh_cache=False)
+    assert segid_to_mesh == {}
+
+
+def test_manifest_fragment_index_uses_callers_cv():
+    cloudvolume_utils.clear_manifest_fragment_indexes()
+    first_cv = _mesh_cv("test://manifest_index")
+    second_cv = _mesh_cv("test://manifest_index")
+    index = cloudvolume_utils.get_manifest_fragment_index(first_cv)
+    assert cloudvolume_utils.get_manifest_fragment_index(second_cv) is index
+
+    calls = []
+    get_manifests = second_cv.mesh._get_manifests
+    second_cv.mesh._get_manifests = lambda segids: (
+        calls.append(segids) or get_manifests(segids))
+    bbox = cloudvolume.Bbox([0, 0, 0], [1000, 600, 50])
+    assert [len(fns) for fns in index.intersecting(
+        second_cv, [1, 2], bbox).values()] == [2, 2]
+    assert calls == [[1, 2]]
+
+    cloudvolume_utils.clear_manifest_fragment_indexes()
+    assert cloudvolume_utils.get_manifest_fragment_index(
+        second_cv) is not index
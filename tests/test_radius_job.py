@@ -0,0 +1,30 @@
+import numpy
+
+import meshparty.trimesh_io
+
+from pycilium.utils.radius_job import run_radius_job
+
+
+def _box_mesh():
+    vertices = numpy.array([
+        [x, y, z] for x in (-5., 15.) for y in (-5., 5.) for z in (-5., 5.)])
+    faces = numpy.array([
+        [0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1],
+        [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3]])
+    return meshparty.trimesh_io.Mesh(vertices, faces, process=False)
+
+
+def test_run_radius_job_none_mesh(tmp_path):
+    skel = (numpy.array([[0., 0., 0.], [10., 0., 0.]]),
+            numpy.array([[0, 1]]), 0)
+    cn_to_skelcd = {"ok": skel, "no_mesh": skel, "no_skel": None}
+    cn_to_bbox_mesh = {
+        "ok": {1: _box_mesh()}, "no_mesh": None, "no_skel": {}}
+
+    cn_to_mpskel, cn_to_record = run_radius_job(
+        cn_to_skelcd, cn_to_bbox_mesh, tmp_path, max_workers=1)
+
+    assert {cn: r["status"] for cn, r in cn_to_record.items()} == {
+        "ok": "ok", "no_mesh": "none", "no_skel": "none"}
+    assert cn_to_mpskel["no_mesh"] is None
+    assert cn_to_mpskel["ok"] is not None
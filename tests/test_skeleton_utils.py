@@ -0,0 +1,23 @@
+import numpy
+import pytest
+
+from pycilium.utils.skeleton_utils import resample_skeleton
+
+
+def _line_skeleton():
+    vtxs = numpy.array([[0., 0., 0.], [10., 0., 0.], [20., 0., 0.]])
+    edges = numpy.array([[0, 1], [1, 2]])
+    return vtxs, edges, 0
+
+
+def test_resample_skeleton_spacing():
+    vtxs, edges, root = resample_skeleton(_line_skeleton(), 4.)
+    assert len(vtxs) == 6
+    assert numpy.linalg.norm(
+        vtxs[edges[:, 0]] - vtxs[edges[:, 1]], axis=1).max() <= 4.
+
+
+@pytest.mark.parametrize("spacing", [0, -1., numpy.nan])
+def test_resample_skeleton_invalid_spacing(spacing):
+    with pytest.raises(ValueError):
+        resample_skeleton(_line_skeleton(), spacing)